@@ -2,28 +2,14 @@
 
 import shlex
 from util import bell, sigint, shprint
-from api import RHAPI, _rebuildOption
-from time import sleep
-from threading import Thread
-from collections import defaultdict, deque
-from statistics import stdev
-import termplot
-from colorclass import Color
-
-def der(RAW):
-    def oper(z,y,x):
-        return (3*x-4*y+z)/2
-    l=list(map(oper,RAW[2:],RAW[1:-1],RAW[:-2]))
-    return l
-
-def der2(RAW):
-    try:
-        ret=der(der(RAW))[0]
-        if ret==[]:
-            ret=None
-    except IndexError:
-        ret=None
-    return ret
+from stops import StopEngine
+from execution import Executor
+from time import time
+from threading import Thread, Lock
+from ticks import TickStore
+from ticklog import TickLog
+from metrics import tag
+import numpy as np
 
 class RHAlgo():
 
@@ -32,147 +18,130 @@ class RHAlgo():
         self.API = API
         self.shell = shell
 
-        self.stops={}
-        self.watch=defaultdict(lambda: deque(maxlen=5*12+1))
-        self.watchdata=[defaultdict(lambda: deque(maxlen=15*12)),defaultdict(lambda: deque(maxlen=15*12)),defaultdict(lambda: deque(maxlen=15*12))]
-        self.watchsd=[defaultdict(lambda: [None]*3),defaultdict(lambda: [None]*3),defaultdict(lambda: [None]*3)]
+        self.stops=StopEngine(API,int(config['MT']),self.execStop)
+        self.executor=Executor(API,int(config.get('STEPS',5)),float(config.get('DEADLINE',60)))
+        self.watch=TickStore()
+        self.watchLock=Lock()
+        self.ticklog=TickLog(config.get('TICKS','cache/ticks'),days=float(config.get('TICKKEEP',30)))
+        self.watchIns={}
+        self.watchSub=None
 
     def listen(self):
         self.initWatch()
 
     def handleStop(self,data):
         [pos,price]=shlex.split(data)
-        x=self.stops.get(pos,{})
-        if price in x:
+        if not self.stops.arm(pos,float(price)):
             shprint('Stop order already set up at this price')
-            return
-        def dowork():
-            while True:
-                sleep(int(self.config['MT']))
-                (_,(bid,ask))=self.API.positionQuote(pos)
-                if float(bid)<price:
-                    shprint('Executing stop order\a')
-                    cmdstr='c \'{} {}\''.format(pos,price)
-                    self.shell.recvcmd(cmdstr)
-# TO-DO: Fix
-# This only works for options
-# And it works badly
-                    while True:
-                        sleep(5)
-                        (_,(bid,ask))=self.API.positionQuote(pos)
-                        tmp=self.API.getPosition(pos)
-                        q=int(float(tmp[0]['pending_sell_quantity']))+int(float(tmp[0]['pending_buy_quantity']))
-                        if q>0:
-                            shprint('Repricing stop order')
-#                            cmdstr='C {}'.format(pos)
-                            cmdstr='C X'
-                            self.shell.recvcmd(cmdstr)
-                            sleep(3)
-                            cmdstr='c \'{} {}\''.format(pos,bid)
-                            self.shell.recvcmd(cmdstr)
-                        else:
-                            break
-                    return
-        t=Thread(target=dowork,daemon=True)
-        x[price]=t
-        price=float(price)
-        t.start()
+
+    def handleListStops(self):
+        return self.stops.list()
+
+    def handleDisarm(self,data):
+        l=shlex.split(data)
+        return self.stops.disarm(l[0],float(l[1]) if len(l)>1 else None)
+
+# Called by the stop engine once a stop has been crossed
+    def execStop(self,pos,price,order,quote=None):
+        self.executor.close(pos,price,order,quote)
 
     def handleWatch(self,data):
         l = shlex.split(data)
-        for symb in l:
-            if symb in self.watch:
-                shprint('{} already being watched'.format(symb))
-                continue
-            self.watch[symb.upper()]=deque(maxlen=5*12+1)
-        for symb in shlex.split(self.config['WATCH']):
-            if symb not in self.watch:
-                self.watch[symb.upper()]=deque(maxlen=5*12+1)
-            
+        with self.watchLock:
+            new=[]
+            for symb in l:
+                if symb.upper() in self.watch:
+                    shprint('{} already being watched'.format(symb))
+                    continue
+                new.append(symb.upper())
+            new.extend(x.upper() for x in shlex.split(self.config['WATCH']) if x.upper() not in self.watch)
+            for symb in new:
+                self.watch.add(symb)
+# Picks up where the last session left off
+            self.ticklog.replay(self.watch,new)
+            names=[x for x in self.watch if x not in self.watchIns.values()]
+        self.watchIns.update(self._watchUrls(names))
+        if self.watchSub is not None:
+            self.watchSub.update(list(self.watchIns))
+
+# Instrument URL of each watched name
+    def _watchUrls(self,names):
+        stocks=[x for x in names if len(x.split())==1]
+        options={}
+        for x in names:
+            parts=x.split()
+            if len(parts)==4:
+                parts[2]='{:.2f}'.format(float(parts[2]))
+                options[' '.join(parts)]=x
+        res={}
+        if stocks:
+            for (symb,ID) in (self.API.getStockID(stocks) or {}).items():
+                res[self.API._ep('instruments')+ID+'/']=symb
+        if options:
+            for (o,ID) in (self.API.getOptionID([x.split() for x in options]) or {}).items():
+                if o in options:
+                    res[self.API._ep('instruments',True)+ID+'/']=options[o]
+        return res
+
+# One pass of the watch loop: store the quotes and alert on flagged
+# instruments. quotes is {instrument URL: quote}; without it, the
+# watchlist is quoted now
+    def watchTick(self,quotes=None):
+        if not self.watch:
+            return
+        if quotes is None:
+            ins=list(self.watchIns)
+            quotes={x:y for (x,y) in zip(ins,self.API.hub.get(ins,0)) if y}
+        s={self.watchIns[x]:float(y['last_trade_price']) for (x,y) in quotes.items() if x in self.watchIns and y['last_trade_price'] is not None}
+
+        with self.watchLock:
+            (rows,d2)=self.watch.push(s)
+            flags=self.watch.flags(rows,d2,float(self.config['NSD']))
+            self.ticklog.append(time(),s)
 
+        if flags:
+            bell()
+            def dowork():
+                try:
+                    with tag('alert'):
+                        self.handleCW(flags=flags)
+                except Exception as e:
+                    shprint('Alert on {}: {}'.format(' '.join(flags),e))
+            Thread(target=dowork,daemon=True).start()
+
+# The watchlist is quoted by the quote hub along with everything else
     def initWatch(self):
-        def calcSD(q,sd,n):
-            l = [x for x in list(q) if x is not None]
-            if len(l)<24:
-                return (1000,n)
-            elif len(l)<len(q):
-                return (float(self.config['NSD'])*stdev(l),n)
-            elif len(l)==len(q):
-                if n<12:
-                    return (sd,n+1)
-                else:
-                    return (float(self.config['NSD'])*stdev(l),0)
-
-        def dowork():
-            nsd=[defaultdict(lambda: 0),defaultdict(lambda: 0),defaultdict(lambda: 0)]
-            while True:
-                sleep(int(self.config['DMT']))
-                stocks=[]
-                options=[]
-                if not self.watch:
-                    continue
-                for a in self.watch:
-                    parts=a.split()
-                    if len(parts)==1:
-                        stocks.append(parts[0])
-                    else:
-                        options.append(parts)
-                s = self.API.stockQuote(stocks)
-                s = {x['symbol']:float(x['last_trade_price']) for x in s} if s is not None else {}
-                o = self.API.optionQuote(options)
-                o = {_rebuildOption(x[1]):float(x[0]['last_trade_price']) for x in o} if o is not None else {}
-                s.update(o)
-
-                flags=[]
-                for a in s:
-                    self.watch[a].appendleft(s[a])
-                    l0 = list(self.watch[a])
-
-                    for b in range(3):
-                        fints = lambda x: (5*x*x+x+2)//2
-                        l=l0[::fints(b)]
-                        tmp=der2(l[:5])
-                        self.watchdata[b][a].appendleft(tmp)
-                        (self.watchsd[b][a],nsd[b][a])=calcSD(self.watchdata[b][a],self.watchsd[b][a],nsd[b][a])
-                        try:
-                            if abs(tmp)>self.watchsd[b][a]:
-                               flags.append(a)
-                        except TypeError:
-                            pass
-
-                if flags:
-                    bell()
-                    self.handleCW(flags=flags)
-
-        t=Thread(target=dowork,daemon=True)
-        t.start()
+        self.watchSub=self.API.subscribe(list(self.watchIns),int(self.config['DMT']),self.watchTick,'watch')
 
+# Latest price, and each timescale's derivative in units of its threshold
     def handleCW(self,flags=[]):
         data={}
-        if flags:
-            for a in flags:
-                if not self.watch[a]:
+        with self.watchLock:
+            thr=self.watch.threshold(float(self.config['NSD']))
+            for a in (flags if flags else self.watch):
+                if a not in self.watch:
                     continue
-                data[a]={0:self.watch[a][0]}
-                for b in range(3):
-                    fints = lambda x: (5*x*x+x+2)//2
-                    tmp = self.watchdata[b][a][0]
-                    data[a][fints(b)] = tmp if tmp is None else tmp/self.watchsd[b][a]
-        else:
-            for a in self.watch:
-                if not self.watch[a]:
+                (price,d2,_)=self.watch.latest(a)
+                if price is None:
                     continue
-                data[a]={0:self.watch[a][0]}
-                for b in range(3):
-                    fints = lambda x: (5*x*x+x+2)//2
-                    tmp = self.watchdata[b][a][0]
-                    data[a][fints(b)] = tmp if tmp is None else tmp/self.watchsd[b][a]
+                r=self.watch.rows[a]
+                data[a]={0:float(price)}
+                for b,st in enumerate(self.watch.strides):
+                    data[a][int(st)] = None if np.isnan(d2[b]) else float(d2[b]/thr[b,r])
         self.shell.handleCW(data)
 
+# termplot and colorclass are only needed here
     def handleGraph(self,ID):
+        import termplot
+        from colorclass import Color
         if ID not in self.watch:
             print('Instrument not being watched')
-        data = [x for x in list(self.watch[ID]) if x is not None]
+            return
+        with self.watchLock:
+            data = list(self.watch.history(ID))
+        if not data:
+            print('No data to graph')
+            return
         k=data[-1]
         data = [x/k-1 for x in data]
         data.reverse()
@@ -185,9 +154,11 @@ class RHAlgo():
             print('No data to graph')
 
     def handleTest(self,p):
+        with self.watchLock:
+            data={a:list(self.watch.history(a)) for a in self.watch}
         with open('test2.txt','w') as o:
-            print(self.watch,file=o)
-        print(self.watch)
+            print(data,file=o)
+        print(data)
 
     def close(self):
         pass
@@ -3,7 +3,20 @@
 import requests
 import uuid
 import json
-import datetime
+import time
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from cache import DiskCache, OptionIndex, LRUCache
+from metrics import Metrics
+from scheduler import Scheduler
+from hub import QuoteHub
+from orders import OrderStore, OPEN
 
 # Reconstructs option string from instrument
 def _rebuildOption(dic):
@@ -14,17 +27,40 @@ def _rebuildOption(dic):
     res.append(dic['expiration_date'])
     return ' '.join(res)
 
+# Short name of an instrument: the ticker for a stock,
+# [symbol, C/P, strike, expiration] for an option
+def _instrumentName(res):
+    if 'chain_symbol' in res:
+        return [res['chain_symbol'],res['type'][0].upper(),'{:.2f}'.format(float(res['strike_price'])),res['expiration_date']]
+    return res['symbol']
+
 # TO-DO: Make all errors this class of exception
 class APIException(Exception):
     pass
 
+# Raised by _instrumentQuote when the server rejects the IDs it was
+# given (400), so the caller can narrow down which ones
+class BadQuery(Exception):
+    pass
+
+# Most cancels sent at once by cancelAll, so flattening a book of open
+# orders takes about one round trip
+BURST = 32
+
+# Longest quote URL sent, query string included. Common servers refuse
+# request lines past 8KB; this fits about 78 option instruments.
+MAXURL = 8000
+
+# On a 401, refreshes the token the call was made with and retries once
+# Threads that hit the same expired token share a single refresh
 def loginDec(func):
     def wrapper(*args,**kwargs):
+        tok=args[0].auth_token
         try:
             return func(*args,**kwargs)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code==401:
-                args[0].relogin()
+                args[0].relogin(tok)
                 return func(*args,**kwargs)
         except APIException as e:
             print(e)
@@ -65,14 +101,27 @@ class RHAPI:
         "chains":"chains/"
     }
 
+# Symbol -> instrument ID, shared by every RHAPI in the process
+    stockIDs = DiskCache('cache/stockid.json',7*86400)
+    chainIDs = DiskCache('cache/chainid.json',7*86400)
+    options = OptionIndex(3600)
+# Instrument URL -> instrument metadata
+    instruments = LRUCache(4096)
+# Synced order history, see orders.OrderStore
+    orderDB = 'cache/orders.db'
+
     def _ep(self,s,opt=False):
         base_url='https://api.robinhood.com/'
         if opt:
             base_url+='options/'
         return base_url+self.ep[s]
 
-    def __init__(self):
+    def __init__(self,limit=8):
         self.session = requests.session()
+        self.session.mount('https://',HTTPAdapter(pool_connections=limit,pool_maxsize=max(limit,BURST)))
+        self.metrics=Metrics(self.ep)
+        self.session.hooks['response'].append(self.metrics.hook)
+        self.sched=Scheduler()
         self.session.headers.update({
             "Accept": "*/*",
             "Accept-Encoding": "gzip, deflate",
@@ -88,11 +137,49 @@ class RHAPI:
         self.client_id = 'c82SH0WZOsabOXGP2sxqcj34FxkvfnWRZBKlBjFS'
         self.auth_token=None
         self.refresh_token=None
+        self.expires_at=0
+        self.username=None
+        self.password=None
+        self.account=None
+        self.sessionFile=None
+        self.authLock=Lock()
+        self.scanner=None
+        self.expirations={}
+# Order ID -> True for options, learned from every order seen
+        self.orderKinds=LRUCache(4096)
+        self.orderStore=OrderStore(self.orderDB)
+        self.hub=QuoteHub(self)
+        self.positionWatchers=[]
+        self.aio=AsyncRHAPI(self,limit)
+
+# Swaps the transport under the session, e.g. for transport.ReplayAdapter
+    def mount(self,adapter):
+        self.session.mount('https://',adapter)
+
+# Runs one of the AsyncRHAPI coroutines to completion from blocking code
+    def _sync(self,coro):
+        return asyncio.run(coro)
+
+# With path, tokens and the account are kept in that file between runs
+# A saved session for the same user is reused, or refreshed if it has
+# run out, and the password is only sent when neither works
+# The password is kept for when the server revokes the session
+    def login(self, uname, pwd, path=None):
+        self.sessionFile=path
+        self.username=uname
+        self.password=pwd
+        if path is not None and self._resume():
+            return
+        self._passwordLogin()
+        account=self.getAccount()
+        self.account=account['account_number']
+        self.account_url=account['url']
+        self._saveSession()
 
-    def login(self, uname, pwd):
+    def _passwordLogin(self):
         payload = {
-            'username': uname,
-            'password': pwd,
+            'username': self.username,
+            'password': self.password,
             'scope': 'internal',
             'grant_type': 'password',
             'client_id': self.client_id,
@@ -104,35 +191,113 @@ class RHAPI:
         data=req.json()
 
         if 'access_token' in data.keys() and 'refresh_token' in data.keys():
-            self.auth_token=data['access_token']
-            self.session.headers.update({'Authorization':'Bearer ' + self.auth_token})
-            self.refresh_token=data['refresh_token']
-            account=self.getAccount()
-            self.account=account['account_number']
-            self.account_url=account['url']
+            self._setTokens(data)
         else:
             print(data)
             raise Exception('Login failed')
 
-    def relogin(self):
-        payload = {
-            'refresh_token': self.refresh_token,
-            'scope': 'internal',
-            'grant_type': 'refresh_token',
-            'client_id': self.client_id,
-            'expires_in': 86400
+# stale is the token the caller saw fail; if another thread has
+# already replaced it, there is nothing left to do
+# A refresh the server turns down means the session was revoked, and
+# it is dropped for a password login
+    def relogin(self,stale=None):
+        with self.authLock:
+            if stale is not None and stale!=self.auth_token:
+                return
+            payload = {
+                'refresh_token': self.refresh_token,
+                'scope': 'internal',
+                'grant_type': 'refresh_token',
+                'client_id': self.client_id,
+                'expires_in': 86400
+            }
+            req = self.session.post(self._ep('login'),data=payload)
+            data=req.json() if req.ok else {}
+
+            if 'access_token' in data.keys() and 'refresh_token' in data.keys():
+                self._setTokens(data)
+            elif self.password is not None:
+                self._dropSession()
+                self._passwordLogin()
+            else:
+                req.raise_for_status()
+                print(data)
+                raise Exception('Login failed')
+
+    def _setTokens(self,data):
+        self.auth_token=data['access_token']
+        self.refresh_token=data['refresh_token']
+        self.expires_at=time.time()+float(data.get('expires_in',86400))
+        self._saveSession()
+
+    def _resume(self):
+        try:
+            with open(self.sessionFile) as f:
+                data=json.load(f)
+        except (OSError,ValueError):
+            return False
+        if data.get('username')!=self.username:
+            return False
+        self.auth_token=data['access_token']
+        self.refresh_token=data['refresh_token']
+        self.expires_at=data['expires_at']
+        self.account=data['account']
+        self.account_url=data['account_url']
+        if time.time()>self.expires_at-300:
+            try:
+                self.relogin()
+            except Exception:
+                self.auth_token=None
+                self.refresh_token=None
+                self.account=None
+                self._dropSession()
+                return False
+        return True
+
+    def _dropSession(self):
+        if self.sessionFile is not None and os.path.exists(self.sessionFile):
+            os.remove(self.sessionFile)
+
+# Readable by the owner only, and replaced whole so a crash never
+# leaves half a file
+    def _saveSession(self):
+        if self.sessionFile is None or self.account is None:
+            return
+        data={
+            'username':self.username,
+            'access_token':self.auth_token,
+            'refresh_token':self.refresh_token,
+            'expires_at':self.expires_at,
+            'account':self.account,
+            'account_url':self.account_url
         }
-        req = self.session.post(self._ep('login'),data=payload)
-        req.raise_for_status()
-        data=req.json()
+        os.makedirs(os.path.dirname(self.sessionFile) or '.',exist_ok=True)
+        tmp=self.sessionFile+'.tmp'
+        fd=os.open(tmp,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600)
+        os.fchmod(fd,0o600)
+        with os.fdopen(fd,'w') as f:
+            json.dump(data,f)
+        os.replace(tmp,self.sessionFile)
+
+# Headers are built per request rather than kept on the shared session
+# The token is refreshed a few minutes before it runs out
+    def _headers(self,headers=None):
+        if self.refresh_token and time.time()>self.expires_at-300:
+            self.relogin(self.auth_token)
+        res={'Authorization':'Bearer ' + self.auth_token} if self.auth_token else {}
+        res.update(headers or {})
+        return res
 
-        if 'access_token' in data.keys() and 'refresh_token' in data.keys():
-            self.auth_token=data['access_token']
-            self.session.headers.update({'Authorization': 'Bearer ' + self.auth_token})
-            self.refresh_token=data['refresh_token']
-        else:
-            print(data)
-            raise Exception('Login failed')
+# Both go through the scheduler, which may hold a request back for the
+# rate limit or, for background callers, raise scheduler.Shed instead
+# Headers are built once a request is let through, so a long wait
+# never sends an expired token
+    def _get(self,url,headers=None,**kwargs):
+        key=(url,tuple(sorted((kwargs.get('params') or {}).items())))
+        return self.sched.send(url,lambda: self.session.get(url,headers=self._headers(headers),**kwargs),key)
+
+    def _post(self,url,headers=None,**kwargs):
+        return self.sched.send(url,lambda: self.session.post(url,headers=self._headers(headers),**kwargs))
 
 # For some reason, I made the design choice to make sure
 # that an account is logged in before it can be logged out
@@ -142,79 +307,133 @@ class RHAPI:
             'client_id': self.client_id,
             'token': self.auth_token
         }
-        req = self.session.post(self._ep('logout'),data=payload)
+        req = self._post(self._ep('logout'),data=payload)
         req.raise_for_status()
-        self.session.headers.update({'Authorization': None})
         self.auth_token = None
+        self.refresh_token = None
+        self._dropSession()
 
     @loginDec
     def getAccount(self):
-        req = self.session.get(self._ep('accounts'))
+        req = self._get(self._ep('accounts'))
         req.raise_for_status()
         return req.json()['results'][0]
 
+# Yields results as pages arrive, decoding each page once
+# Iteration ends after maxpages pages, or at the first result
+# for which stop(result) is true (that result is not yielded)
+    def _paginate(self,req,stop=None,maxpages=None):
+        pages=0
+        while True:
+            req.raise_for_status()
+            data=req.json()
+            pages+=1
+            for x in data['results']:
+                if stop is not None and stop(x):
+                    return
+                yield x
+            if not data['next'] or (maxpages is not None and pages>=maxpages):
+                return
+            req = self._get(data['next'])
+
     @loginDec
-    def _handlePagination(self,req):
-        res=req.json()['results']
-        if req.json()['next']:
-            req = self.session.get(req.json()['next'])
-            res.extend(self._handlePagination(req))
-        return res
+    def _handlePagination(self,req,stop=None,maxpages=None):
+        return list(self._paginate(req,stop,maxpages))
 
 # Turns stock symbol into instrument ID
     @loginDec
     def getStockID(self,stocks,flag=True):
         if not(type(stocks) is list):
             stocks=[stocks]
-        res={}
+        res=self.stockIDs.getMany(stocks)
+        found={}
         for a in stocks:
-            req = self.session.get(self._ep('instruments'),params={'symbol':a})
+            if a in res or a in found:
+                continue
+            req = self._get(self._ep('instruments'),params={'symbol':a})
             req.raise_for_status()
             try:
                 x=req.json()['results'][0]
-                res[a]=x['id']
+                found[a]=x['id']
+                self.instruments.set(x['url'],x)
             except:
                 print('{} is not a valid Stock ticker'.format(a))
                 continue
+        self.stockIDs.update(found)
+        res.update(found)
         return res
 
 # Turns stock instrument ID into option chain ID
     @loginDec
     def getChainID(self,IDs):
-        req = self.session.get(self._ep('chains',True),params={'equity_instrument_ids':','.join(IDs)})
+        if not IDs:
+            return {}
+        req = self._get(self._ep('chains',True),params={'equity_instrument_ids':','.join(IDs)})
         req.raise_for_status()
         res = self._handlePagination(req)
         return {x['symbol']:x['id'] for x in res if x['can_open_position']}
 
+# Turns stock symbols into option chain IDs, going through the cache first
+    @loginDec
+    def getChainIDs(self,symbols):
+        res=self.chainIDs.getMany(symbols)
+        miss=list(set(x for x in symbols if x not in res))
+        if miss:
+            found=self.getChainID(list(self.getStockID(miss).values()))
+            self.chainIDs.update(found)
+            res.update(found)
+        return res
+
+# Upcoming expiration dates of each symbol's chain, oldest first
+# They are kept as long as the option index keeps contracts
+    @loginDec
+    def getExpirations(self,symbols):
+        now=time.time()
+        res={x:self.expirations[x][1] for x in symbols if x in self.expirations and now-self.expirations[x][0]<self.options.ttl}
+        miss=list(set(x for x in symbols if x not in res))
+        if miss:
+            IDs=list(self.getStockID(miss).values())
+            if not IDs:
+                return res
+            req=self._get(self._ep('chains',True),params={'equity_instrument_ids':','.join(IDs)})
+            req.raise_for_status()
+            found=[x for x in self._handlePagination(req) if x['can_open_position']]
+            self.chainIDs.update({x['symbol']:x['id'] for x in found})
+            for x in found:
+                self.expirations[x['symbol']]=(now,sorted(x['expiration_dates']))
+                res[x['symbol']]=self.expirations[x['symbol']][1]
+        return res
+
 # Gets instrument IDs for constructed options
+# Queries sharing a chain and expiration are pulled together into
+# the option index, then answered from it
     @loginDec
     def getOptionID(self,os,flag=False):
+        groups=list(set((x[0],x[3]) for x in os))
+        stale=[x for x in groups if not self.options.fresh(*x)]
+        if stale:
+            oids=self.getChainIDs([x[0] for x in stale])
+            for (symbol,exp) in stale:
+                if symbol not in oids:
+                    continue
+                args={
+                    'state':'active',
+#                    'tradability':'tradable',
+                    'chain_id':oids[symbol]
+                    }
+                if exp!='X':
+                    args['expiration_dates']=exp
+                req = self._get(self._ep('instruments',True),params=args)
+                req.raise_for_status()
+                res=self._handlePagination(req)
+                self.options.add(symbol,exp,res)
+                self.instruments.update({x['url']:x for x in res})
         ress=[]
-        ids=[]
-        keys=list(set([x[0] for x in os]))
-        oids=self.getChainID(self.getStockID([x[0] for x in os]).values())
         for o in os:
-            typ=o[1]
-            typ='call' if typ.lower() in ['c','call'] else typ
-            typ='put' if typ.lower() in ['p','put'] else typ
-            args={
-                'state':'active',
-#                'tradability':'tradable',
-                'chain_id':oids[o[0]]
-                }
-            if typ!='X':
-                args['type']=typ
-            if o[2]!='X':
-                args['strike_price']=o[2]
-            if o[3]!='X':
-                args['expiration_dates']=o[3]
-            req = self.session.get(self._ep('instruments',True),params=args)
-            req.raise_for_status()
-            if req.json()['results']==[]:
+            res=self.options.find(o)
+            if res==[]:
                 print('Option query {} is not valid'.format(' '.join(o)))
-                print(req.url)
                 continue
-            res = self._handlePagination(req)
             res.sort(key=lambda x: (x['type'],float(x['strike_price']),x['expiration_date']))
             ress.extend(res)
         if flag:
@@ -231,122 +450,158 @@ class RHAPI:
 
     @loginDec
     def getInstrumentInfo(self,i):
-        req = self.session.get(i)
-        req.raise_for_status()
-        res = req.json()
-        if "options" in i:
-            res['type']=res['type'][0].upper()
-            res['strike_price']='{:.2f}'.format(float(res['strike_price']))
-            return [res['chain_symbol'],res['type'],res['strike_price'],res['expiration_date']]
-        else:
-            return res['symbol']
+        res=self.instruments.get(i)
+        if res is None:
+            req = self._get(i)
+            req.raise_for_status()
+            res=req.json()
+            self.instruments.set(i,res)
+        return _instrumentName(res)
 
+# Fetches any number of instruments, going through the cache first
+# Misses are filled through the list endpoints' ids filter
+# Returns url -> instrument
     @loginDec
-    def _instrumentQuote(self,ins,oflag=False):
+    def getInstruments(self,urls):
+        res=self.instruments.getMany(urls)
+        miss=list(set(x for x in urls if x not in res))
+        for opt in [False,True]:
+            ids=[x.rstrip('/').split('/')[-1] for x in miss if ('options' in x)==opt]
+            for x in range(0,len(ids),75):
+                req = self._get(self._ep('instruments',opt),params={'ids':','.join(ids[x:x + 75])})
+                req.raise_for_status()
+                found={y['url']:y for y in self._paginate(req)}
+                self.instruments.update(found)
+                res.update(found)
+        return res
+
+    def _quoteUrl(self,oflag):
         if oflag:
-            url=self._ep('marketdata')+'options/'
-        else:
-            url=self._ep('quotes')
-        req = self.session.get(url,params={'instruments':','.join(ins)})
+            return self._ep('marketdata')+'options/'
+        return self._ep('quotes')
+
+    @loginDec
+    def _instrumentQuote(self,ins,oflag=False):
+        req = self._get(self._quoteUrl(oflag),params={'instruments':','.join(ins)})
         if req.status_code==400:
-            print('All requested quote queries are invalid.')
-            return
+            raise BadQuery(req.text)
         req.raise_for_status()
         return req.json()['results']
 
+# Splits instrument URLs into as few quote requests as fit in MAXURL
+    def _quoteChunks(self,ins,oflag=False):
+        res=[]
+        size=MAXURL
+        for x in ins:
+            n=len(quote_plus(x))+3
+            if size+n>MAXURL:
+                res.append([])
+                size=len(self._quoteUrl(oflag))+len('?instruments=')-3
+            res[-1].append(x)
+            size+=n
+        return res
+
+# Quotes in the order of ins, None where there is no quote
+    @loginDec
+    def instrumentQuote(self,ins,oflag=False):
+        if ins==[]:
+            return []
+        return self._sync(self.aio.instrumentQuote(ins,oflag))
+
     @loginDec
     def stockQuote(self,stocks):
         if stocks==[]:
             return
         sids=self.getStockID(stocks)
         sidurls=[self._ep('instruments')+x+'/' for x in sids.values()]
-        return self._instrumentQuote(sidurls)
+        return [x for x in self.hub.get(sidurls) if x]
+
+# Calls callback({instrument URL: quote}) every interval seconds with
+# quotes for the instruments, polled together with every other
+# subscriber's; see hub.QuoteHub
+    def subscribe(self,instruments,interval,callback,who=None):
+        return self.hub.subscribe(instruments,interval,callback,who)
 
+# With ul, each quote also carries its underlying's last trade price,
+# and missing greeks are computed locally
     @loginDec
-    def optionQuote(self,options):
-        if options==[]:
-            return
+    def optionQuote(self,options,ul=False):
+        return self._sync(self.aio.optionQuote(options,ul))
+
+    def _stockPayload(self,a,ID):
+        return {
+            'account':self.account_url,
+            'instrument':self._ep('instruments')+ID+'/',
+            'price':a[3] if a[3]!='X' else '0.01',
+            'quantity':a[2],
+            'side':a[1].lower(),
+            'symbol':a[0],
+            'time_in_force':'gtc',
+            'trigger':'immediate',
+            'type':'market' if a[3]=='X' else 'limit'
+        }
 
-        info=self.getOptionID(options,True)
-        ress=[x['url'] for x in info]
-        resss=[ress[x:x + 75] for x in range(0, len(ress), 75)]
-        res=[]
-        for ress in resss:
-            res.extend(self._instrumentQuote(ress,True))
-        if res==[]:
-            print('All requested option queries are invalid.')
-            return
-        return zip(res,info)
+    def _optionPayload(self,o,ID,effect):
+        side = o[1].lower()
+        sf = side=='sell'
+        direction = 'credit' if sf else 'debit'
+        legs=[{
+            'option':self._ep('instruments',True)+ID+'/',
+            'side':side,
+            'position_effect':effect,
+            'ratio_quantity':'1'
+        }]
+        return {
+            'account':self.account_url,
+            'price':o[3] if o[3]!='X' else '0.01',
+            'quantity':o[2],
+            'time_in_force':'gtc',
+            'trigger':'immediate',
+            'type':'market' if o[3]=='X' else 'limit',
+            'direction':direction,
+            'legs':legs,
+            'override_day_trade_checks':False,
+            'override_dtbp_checks':False,
+            'ref_id':str(uuid.uuid4())
+        }
+
+    def _learn(self,orders,opt):
+        for x in orders:
+            if x and 'id' in x:
+                self.orderKinds.set(x['id'],opt)
+        self.orderStore.add(self.account,opt,orders)
 
     @loginDec
-    def stockOpen(self,stocks):
-        if stocks==[]:
-            return []
-        IDs=self.getStockID([x[0] for x in stocks])
-        ress=[]
-        for a in stocks:
-            url = self._ep('instruments')+IDs[a[0]]+'/'
-            payload = {
-                'account':self.account_url,
-                'instrument':url,
-                'price':a[3] if a[3]!='X' else '0.01',
-                'quantity':a[2],
-                'side':a[1].lower(),
-                'symbol':a[0],
-                'time_in_force':'gtc',
-                'trigger':'immediate',
-                'type':'market' if a[3]=='X' else 'limit'
-            }
-            req=self.session.post(self._ep('orders'),data=payload)
+    def _placeStock(self,payload):
+        req=self._post(self._ep('orders'),data=payload)
+        req.raise_for_status()
+        self._learn([req.json()],False)
+        return req.json()
+
+# The content type is set per request, since the session is shared between threads
+    @loginDec
+    def _placeOption(self,payload):
+        req = self._post(self._ep('orders',True),json=payload,headers={'Content-Type':'application/json'})
+        try:
             req.raise_for_status()
-            ress.append(req.json())
-        return ress
+        except:
+            print(req.text)
+        self._learn([req.json()],True)
+        return req.json()
+
+    @loginDec
+    def stockOpen(self,stocks):
+        return self._sync(self.aio.stockOpen(stocks))
 
     @loginDec
     def optionOpen(self,options,effect='open'):
-        if options==[]:
-            return []
-        IDs = self.getOptionID([x[0] for x in options])
-        ress=[]
-        for o in options:
-            ID = IDs[' '.join(o[0])]
-            side = o[1].lower()
-            sf = side=='sell'
-            direction = 'credit' if sf else 'debit'
-            legs=[{
-                'option':self._ep('instruments',True)+ID+'/',
-                'side':side,
-                'position_effect':effect,
-                'ratio_quantity':'1'
-            }]
-            payload = {
-                'account':self.account_url,
-                'price':o[3] if o[3]!='X' else '0.01',
-                'quantity':o[2],
-                'time_in_force':'gtc',
-                'trigger':'immediate',
-                'type':'market' if o[3]=='X' else 'limit',
-                'direction':direction,
-                'legs':legs,
-                'override_day_trade_checks':False,
-                'override_dtbp_checks':False,
-                'ref_id':str(uuid.uuid4())
-            }
-            self.session.headers.update({'content-type':'application/json'})
-            req = self.session.post(self._ep('orders',True),json=payload)
-            self.session.headers.update({"Content-Type": "application/x-www-form-urlencoded; charset=utf-8"})
-            try:
-                req.raise_for_status()
-            except:
-                print(req.text)
-            ress.append(req.json())
-        return ress
+        return self._sync(self.aio.optionOpen(options,effect))
 
     @loginDec
     def getPosition(self,ID):
         try:
             xstr='{}/{}/'.format(self.account,ID)
-            req=self.session.get(self._ep('positions')+xstr)
+            req=self._get(self._ep('positions')+xstr)
             req.raise_for_status()
             res=req.json()
             flag=True
@@ -355,7 +610,7 @@ class RHAPI:
                 raise e
             try:
                 xstr='{}/'.format(ID)
-                req=self.session.get(self._ep('positions',True)+xstr)
+                req=self._get(self._ep('positions',True)+xstr)
                 req.raise_for_status()
                 res=req.json()
                 flag=False
@@ -363,93 +618,131 @@ class RHAPI:
                 raise APIException("ERROR: Position {} cannot be found.".format(ID))
         return (res,flag)
 
+# The order that closes what is left of a position at price p
+# Returns (flag, instrument URL, [symbol, side, quantity, price]),
+# flag being True for stocks
+    def _closeOrder(self,ID,p='X'):
+        (res,flag)=self.getPosition(ID)
+        res=self._closeFrom(res,flag,p)
+        if res[2][2]==0:
+            print("Position {} cannot be closed because you do not own any of it.".format(ID))
+        return res
+
+# The same from a position as returned by the API
+    def _closeFrom(self,res,flag,p='X'):
+        aq=int(float(res['quantity']))-int(float(res['pending_sell_quantity']))
+        if flag:
+            symbol=self.getInstrumentInfo(res['instrument'])
+            return (flag,res['instrument'],[symbol,'sell',aq,p])
+        symbol=self.getInstrumentInfo(res['option'])
+        return (flag,res['option'],[symbol,'sell' if aq>0 else 'buy',abs(aq),p])
+
+# Places the order from _closeOrder, one request in all
+    def _placeClose(self,flag,ins,o):
+        ID=ins.rstrip('/').split('/')[-1]
+        if flag:
+            return self._placeStock(self._stockPayload(o,ID))
+        return self._placeOption(self._optionPayload(o,ID,'close'))
+
     @loginDec
     def closePosition(self,poss):
         stocks=[]
         options=[]
         for a in poss:
-            (res,flag)=self.getPosition(a[0])
-            aq=int(float(res['quantity']))-int(float(res['pending_sell_quantity']))
-            if aq==0:
-                print("Position {} cannot be closed because you do not own any of it.".format(a[0]))
-            try:
-                p=a[1]
-            except:
-                p='X'
-            if flag:
-                symbol=self.getInstrumentInfo(res['instrument'])
-                di='sell'
-                q=aq
-                stocks.append([symbol,di,q,p])
-            else:
-                symbol=self.getInstrumentInfo(res['option'])
-                di='sell' if aq>0 else 'buy'
-                q=abs(aq)
-                options.append([symbol,di,q,p])
+            (flag,_,o)=self._closeOrder(a[0],a[1] if len(a)>1 else 'X')
+            (stocks if flag else options).append(o)
         return (self.stockOpen(stocks),self.optionOpen(options,'close'))
 
     @loginDec
-    def listPending(self):
-        req=self.session.get(self._ep('orders'))
+    def getOrder(self,ID,opt=False):
+        req=self._get(self._ep('orders',opt)+ID+'/')
         req.raise_for_status()
-        res=self._handlePagination(req)
-        s=[x for x in res if x['cancel'] is not None]
-        req=self.session.get(self._ep('orders',True))
+        self._learn([req.json()],opt)
+        return req.json()
+
+# Brings the order store up to date, then answers from it
+# The first sync downloads the open orders, and later ones only the
+# orders updated since the last sync
+    @loginDec
+    def _pending(self,opt=False):
+        cur=self.orderStore.cursor(self.account,opt)
+        if cur is None:
+            (since,params)=(self.orderStore.start(),{'state':','.join(OPEN)})
+        else:
+            (since,params)=('',{'updated_at[gte]':cur})
+        req=self._get(self._ep('orders',opt),params=params)
         req.raise_for_status()
-        res=self._handlePagination(req)
-        o=[x for x in res if x['cancel_url'] is not None]
-        return (s,o)
+        self.orderStore.add(self.account,opt,list(self._paginate(req)),True,since)
+        res=self.orderStore.pending(self.account,opt)
+        for x in res:
+            self.orderKinds.set(x['id'],opt)
+        return res
+
+    @loginDec
+    def listPending(self):
+        return self._sync(self.aio.listPending())
 
     @loginDec
     def cancelOrder(self,x):
-        url=(self._ep('orders')+x+'/cancel/',
-            self._ep('orders',True)+x+'/cancel/')
-        req=self.session.post(url[0])
-        if(req.status_code==200):
-            print("Order {} successfully canceled.".format(x))
-            return
-        req=self.session.post(url[1])
-        if(req.status_code==200):
+        if self._cancel(x):
             print("Order {} successfully canceled.".format(x))
-            return
-        print("Order {} unsuccessfully canceled.".format(x))
+        else:
+            print("Order {} unsuccessfully canceled.".format(x))
 
+# Goes straight to the right endpoint for orders seen before,
+# otherwise tries the equity one, then the options one
+# Returns whether the cancel was accepted
     @loginDec
-    def cancelAll(self):
-        (s,o)=self.listPending()
-        tmp=s
-        tmp.extend(o)
-        for a in tmp:
-            self.cancelOrder(a['id'])
+    def _cancel(self,x):
+        opt=self.orderKinds.get(x)
+        if opt is None:
+            opt=self.orderStore.kind(x)
+        for o in ([opt] if opt is not None else [False,True]):
+            req=self._post(self._ep('orders',o)+x+'/cancel/')
+            if req.status_code==401:
+                req.raise_for_status()
+            if(req.status_code==200):
+                self.orderKinds.set(x,o)
+                return True
+        return False
 
     @loginDec
-    def portfolio(self):
-        req=self.session.get(self._ep('positions'))
-        req.raise_for_status()
-        res=self._handlePagination(req)
-        s=[x for x in res if float(x['quantity'])!=0]
+    def cancelAll(self):
+        return self._sync(self.aio.cancelAll())
 
-        req=self.session.get(self._ep('positions',True))
+    @loginDec
+    def _positions(self,opt=False):
+        req=self._get(self._ep('positions',opt))
         req.raise_for_status()
-        res=self._handlePagination(req)
-        o=[x for x in res if float(x['quantity'])!=0 and float(x['pending_expired_quantity'])==0]
+        if opt:
+            res=[x for x in self._paginate(req) if float(x['quantity'])!=0 and float(x['pending_expired_quantity'])==0]
+        else:
+            res=[x for x in self._paginate(req) if float(x['quantity'])!=0]
+        for f in self.positionWatchers:
+            f(res,opt)
+        return res
 
-        req=self.session.get(self._ep('accounts'))
-        req.raise_for_status()
-        c=req.json()['results'][0]
+# Calls callback(positions, opt) with every list of open positions fetched
+    def watchPositions(self,callback):
+        self.positionWatchers.append(callback)
 
+    @loginDec
+    def _deposits(self):
         url=self._ep('portfolios')+'historicals/{}/'.format(self.account)
-        req=self.session.get(url,params={'bounds':'regular','span':'all'})
+        req=self._get(url,params={'bounds':'regular','span':'all'})
         req.raise_for_status()
-        c['dep']=req.json()['equity_historicals'][0]['adjusted_open_equity']
-        return (s,o,c)
+        return req.json()['equity_historicals'][0]['adjusted_open_equity']
+
+    @loginDec
+    def portfolio(self):
+        return self._sync(self.aio.portfolio())
 
     @loginDec
     def positionQuote(self,ID):
         (res,flag)=self.getPosition(ID)
         tvm = float(res.get('trade_value_multiplier',1))
         orig = '{:.2f}'.format(float(res['average_buy_price'] if flag else res['average_price'])/tvm)
-        res = self._instrumentQuote([res['instrument']] if flag else [res['option']],not flag)[0]
+        res = self.hub.get([res['instrument']] if flag else [res['option']])[0]
         if flag:
             p='{:.2f}'.format(float(res['last_trade_price']))
             cur=(p,p)
@@ -459,34 +752,151 @@ class RHAPI:
             cur=(bp,ap)
         return (orig,cur)
 
+# Best leverage contract for each [symbol, C/P] pair, over the nearest
+# expirations of the chain. The scanner pulls in numpy, so it is only
+# built the first time it is needed
     @loginDec
     def bestOption(self,os):
-        def pickbest(qs,ul):
-            mx={}
-            for a,b in qs:
-                if a is None:
-                    continue
-                i=b['chain_symbol']+' '+b['type'][0].upper()
-                tmp = float(a['delta']) if a['delta'] else 1.0
-                pd = abs(ul[b['chain_symbol']]*tmp/float(a['adjusted_mark_price']))
-                a['pd']=pd
-                if float(a['adjusted_mark_price'])>0.4 and (mx.get(i,None) is None or pd > mx[i][1]['pd']):
-                    mx[i]=(_rebuildOption(b),a)
-            return mx
-
-        tdy=datetime.datetime.today()
-        date=tdy+datetime.timedelta(days=(4-tdy.weekday() if tdy.weekday()<3 else 11-tdy.weekday()))
-        date=date.strftime("%Y-%m-%d")
-
-        ret={}
-
-        underlying = {x['symbol']:float(x['last_trade_price']) for x in self.stockQuote([x[0] for x in os])}
-
-        os = [[x[0],x[1],'X',date] for x in os]
-        qs = self.optionQuote(os)
-
-        return pickbest(qs,underlying)
+        if self.scanner is None:
+            from scanner import ChainScanner
+            self.scanner=ChainScanner(self)
+        res=self.scanner.scan([x[0] for x in os])
+        return {' '.join(x):res[' '.join(x)][0] for x in os if ' '.join(x) in res}
 
     @loginDec
     def test(self):
         pass
+
+# asyncio front end to RHAPI
+# Blocking requests run on a pool of at most limit threads, which also
+# caps how many connections the shared session keeps open.
+# Methods without an override here run the RHAPI method off the loop.
+class AsyncRHAPI:
+
+    def __init__(self,api=None,limit=8):
+        if api is None:
+            api=RHAPI(limit)
+            api.aio=self
+        self.api=api
+        self.limit=limit
+        self.pool=ThreadPoolExecutor(limit)
+        self.burst=ThreadPoolExecutor(BURST)
+
+    def __getattr__(self,name):
+        fn=getattr(self.api,name)
+        if not callable(fn):
+            return fn
+        async def wrapper(*args,**kwargs):
+            return await asyncio.to_thread(fn,*args,**kwargs)
+        return wrapper
+
+# Only for RHAPI methods that never call back into _sync,
+# otherwise a full pool could wait on itself
+# The caller's context goes along, so metrics keep their caller tag
+    async def _run(self,fn,*args,pool=None,**kwargs):
+        loop=asyncio.get_running_loop()
+        ctx=contextvars.copy_context()
+        return await loop.run_in_executor(pool or self.pool,functools.partial(ctx.run,fn,*args,**kwargs))
+
+    async def _map(self,fn,xs,pool=None):
+        return list(await asyncio.gather(*[self._run(fn,x,pool=pool) for x in xs]))
+
+    async def paginate(self,req,stop=None,maxpages=None):
+        it=self.api._paginate(req,stop,maxpages)
+        end=object()
+        while True:
+            x=await self._run(next,it,end)
+            if x is end:
+                return
+            yield x
+
+# Goes through the quote hub, which may call back into _sync
+    async def stockQuote(self,stocks):
+        return await asyncio.to_thread(self.api.stockQuote,stocks)
+
+# Quotes any number of instrument URLs, in concurrent chunks as long as
+# a URL allows, and lines them up with ins (None where there is no quote)
+# A chunk the server rejects is halved until the bad IDs are isolated,
+# so the valid quotes in it are kept; a chunk that fails any other way
+# is left out
+    async def instrumentQuote(self,ins,oflag=False):
+        res={}
+        async def fetch(chunk):
+            try:
+                got=await self._run(self.api._instrumentQuote,chunk,oflag)
+            except BadQuery:
+                if len(chunk)>1:
+                    h=len(chunk)//2
+                    await asyncio.gather(fetch(chunk[:h]),fetch(chunk[h:]))
+                return
+            for x in got or []:
+                if x:
+                    res[x['instrument']]=x
+        await asyncio.gather(*[fetch(x) for x in self.api._quoteChunks(ins,oflag)])
+        return [res.get(x) for x in ins]
+
+    async def optionQuote(self,options,ul=False):
+        if options==[]:
+            return
+        info=await self._run(self.api.getOptionID,options,True)
+        symbols=list(set(x['chain_symbol'] for x in info)) if ul else []
+        (res,under)=await asyncio.gather(
+            asyncio.to_thread(self.api.hub.get,[x['url'] for x in info]),
+            self.stockQuote(symbols))
+        if not any(res):
+            print('All requested option queries are invalid.')
+            return
+# Greeks the API left out are filled in from the mark
+        if ul:
+            from pricing import fillGreeks
+            under={x['symbol']:float(x['last_trade_price']) for x in under or [] if x}
+            for (a,b) in zip(res,info):
+                if a:
+                    a['underlying_price']=under.get(b['chain_symbol'])
+            fillGreeks(zip(res,info))
+        return [(a,b) for (a,b) in zip(res,info) if a]
+
+    async def stockOpen(self,stocks):
+        if stocks==[]:
+            return []
+        IDs=await self._run(self.api.getStockID,[x[0] for x in stocks])
+        return await self._map(self.api._placeStock,[self.api._stockPayload(a,IDs[a[0]]) for a in stocks])
+
+    async def optionOpen(self,options,effect='open'):
+        if options==[]:
+            return []
+        IDs=await self._run(self.api.getOptionID,[x[0] for x in options])
+        return await self._map(self.api._placeOption,[self.api._optionPayload(o,IDs[' '.join(o[0])],effect) for o in options])
+
+    async def listPending(self):
+        return tuple(await self._map(self.api._pending,[False,True]))
+
+    async def cancelAll(self):
+        (s,o)=await self.listPending()
+        await self._map(self.api.cancelOrder,[x['id'] for x in s+o],self.burst)
+
+    async def portfolio(self):
+        (s,o,c,dep)=await asyncio.gather(
+            self._run(self.api._positions,False),
+            self._run(self.api._positions,True),
+            self._run(self.api.getAccount),
+            self._run(self.api._deposits))
+        c['dep']=dep
+
+# Names and quotes for every position, a few batched requests in all
+        surls=[x['instrument'] for x in s]
+        ourls=[x['option'] for x in o]
+        (sinfo,squote,oinfo,oquote)=await asyncio.gather(
+            self._run(self.api.getInstruments,surls),
+            self.instrumentQuote(surls),
+            self._run(self.api.getInstruments,ourls),
+            self.instrumentQuote(ourls,True))
+        squote={x['instrument']:x for x in squote if x}
+        oquote={x['instrument']:x for x in oquote if x}
+        for x in s:
+            x['symbol']=_instrumentName(sinfo[x['instrument']])
+            x['quote']=squote.get(x['instrument'])
+        for x in o:
+            x['symbol']=_instrumentName(oinfo[x['option']])
+            x['quote']=oquote.get(x['option'])
+        return (s,o,c)
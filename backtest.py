@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Replays recorded watchlist ticks through the watch loop's detector
+#
+#   ./backtest.py cache/ticks --nsd 2.5 3 3.5 4 --strides 1,4,12 4,12 12
+#
+# The detector is TickStore.ratios, the whole-history form of the watch
+# loop's push() and threshold(), run once over the union of the strides.
+# What each setting would have flagged then falls out without running
+# it again: a tick flags when any of the setting's strides has
+# |d2| > nsd * std, so |d2| / std per tick and stride covers every nsd.
+# Symbols are split across processes, since their rows never interact.
+# For each setting, the report has the number of flagged ticks and the
+# mean absolute move after each horizon (in ticks), next to the mean
+# absolute move after every tick.
+
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from ticks import TickStore
+from ticklog import load
+
+def ratios(args):
+    (prices,strides)=args
+    return TickStore(strides=strides).ratios(prices)
+
+# Relative move from each tick to horizon ticks later, NaN past the end
+# or where either tick is missing
+def moves(prices,horizon):
+    res=np.full(prices.shape,np.nan)
+    if horizon<len(prices):
+        res[:-horizon]=prices[horizon:]/prices[:-horizon]-1
+    return res
+
+def run(prices,nsds,sets,horizons,procs=None):
+    strides=sorted(set(x for s in sets for x in s))
+    chunks=[x for x in np.array_split(np.arange(prices.shape[1]),procs or 1) if len(x)]
+    with Pool(len(chunks)) as p:
+        parts=p.map(ratios,[(prices[:,x],strides) for x in chunks])
+    r=np.concatenate(parts,axis=2)
+    mv=[np.abs(moves(prices,h)) for h in horizons]
+    res=[('all ticks','',int(np.count_nonzero(~np.isnan(prices))),[np.nanmean(m) for m in mv])]
+# Only ticks above the lowest nsd can flag at all, and they are few
+    mv=[m.ravel() for m in mv]
+    for s in sets:
+        best=r[:,[strides.index(x) for x in s],:].max(axis=1).ravel()
+        cand=np.flatnonzero(best>min(nsds))
+        best=best[cand]
+        cmv=[m[cand] for m in mv]
+        for nsd in nsds:
+            hit=best>nsd
+            res.append((','.join(str(x) for x in s),nsd,int(hit.sum()),[np.nanmean(m[hit]) if hit.any() else np.nan for m in cmv]))
+    return res
+
+def main():
+    ap=argparse.ArgumentParser(description='Counts the alerts the watch loop would have raised on recorded ticks, and the moves that followed')
+    ap.add_argument('path',nargs='?',default='cache/ticks',help='tick log directory (config TICKS)')
+    ap.add_argument('--nsd',type=float,nargs='+',default=[2.5,3.0,3.5,4.0,4.5])
+    ap.add_argument('--strides',nargs='+',default=['1,4,12'],help='comma separated timescales, in ticks, one setting each')
+    ap.add_argument('--horizon',type=int,nargs='+',default=[1,12,60],help='ticks after an alert to measure the move at')
+    ap.add_argument('--symbols',nargs='+',help='only these symbols')
+    ap.add_argument('-j',type=int,default=None,help='processes, one per CPU by default')
+    a=ap.parse_args()
+
+    try:
+        (ts,names,prices)=load(a.path)
+    except OSError as e:
+        ap.exit(1,'Cannot read ticks under {}: {}\n'.format(a.path,e))
+    if a.symbols:
+        keep=[i for i,x in enumerate(names) if x in a.symbols]
+        names=[names[i] for i in keep]
+        prices=prices[:,keep]
+    if not names or not len(ts):
+        ap.exit(1,'No ticks of {} under {}\n'.format(' '.join(a.symbols) if a.symbols else 'any symbol',a.path))
+    sets=[[int(y) for y in x.split(',')] for x in a.strides]
+    procs=a.j
+    if procs is None:
+        from os import cpu_count
+        procs=cpu_count()
+
+    t=time.perf_counter()
+    res=run(prices,a.nsd,sets,a.horizon,procs)
+    print('{} ticks of {} symbols over {} settings in {:.1f}s'.format(len(ts),len(names),len(sets)*len(a.nsd),time.perf_counter()-t))
+    print('{:<12}{:>6}{:>10}'.format('strides','nsd','alerts')+''.join('{:>12}'.format('|move| {}'.format(h)) for h in a.horizon))
+    for (s,nsd,n,mv) in res:
+        print('{:<12}{:>6}{:>10}'.format(s,nsd,n)+''.join('{:>11.3f}%'.format(100*x) for x in mv))
+
+if __name__ == '__main__':
+    main()
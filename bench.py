@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of shell commands and algo loops
+#
+# Record a fixture once, with network, by adding RECORD "fixture.jsonl"
+# to config, emptying cache/, and running the commands to benchmark in
+# ./shell.py. Then, anywhere:
+#
+#   ./bench.py fixture.jsonl -c "q SPY" -c p -c lo -c watch -c "cw SPY"
+#
+# Each command runs against transport.ReplayAdapter standing in for the
+# API. watch is one pass of the watch loop over --watch, stops one tick
+# of the stop engine over --stop positions, cw calls handleCW directly,
+# on the prices of the watch passes run before it.
+# The lookup caches start empty in a scratch directory, so the first run
+# of a command is cold and the median is warm.
+
+import io
+import time
+import shlex
+import argparse
+import tracemalloc
+import statistics
+import tempfile
+from contextlib import redirect_stdout
+from api import RHAPI
+from cache import DiskCache, OptionIndex, LRUCache
+from shell import RHShell
+from transport import ReplayAdapter
+
+def run(sh,line):
+    args=shlex.split(line)
+    if args[0]=='watch':
+        sh.algo.watchTick()
+    elif args[0]=='stops':
+        sh.algo.stops.tick()
+    elif args[0]=='cw':
+        sh.algo.handleCW(flags=args[1:])
+    else:
+        sh.onecmd(line)
+
+def main():
+    ap=argparse.ArgumentParser(description='Replays a fixture through the shell and reports requests, time and memory per command')
+    ap.add_argument('fixture')
+    ap.add_argument('-c','--cmd',action='append',help='command to time, repeatable')
+    ap.add_argument('-n',type=int,default=5,help='runs per command')
+    ap.add_argument('--latency',type=float,default=0.0,help='seconds added to every request')
+    ap.add_argument('--p401',type=float,default=0.0,help='share of requests answered with a 401')
+    ap.add_argument('--p429',type=float,default=0.0,help='share of requests answered with a 429')
+    ap.add_argument('--watch',default='SPY',help='watchlist for the watch loop')
+    ap.add_argument('--stop',action='append',default=[],help='"<ID> <price>" stop to arm, repeatable')
+    a=ap.parse_args()
+    cmds=a.cmd or ['q SPY','p','lo','watch','cw SPY']
+
+    tmp=tempfile.mkdtemp()
+    RHAPI.stockIDs=DiskCache(tmp+'/stockid.json',RHAPI.stockIDs.ttl)
+    RHAPI.chainIDs=DiskCache(tmp+'/chainid.json',RHAPI.chainIDs.ttl)
+    RHAPI.options=OptionIndex(RHAPI.options.ttl)
+    RHAPI.instruments=LRUCache(RHAPI.instruments.maxsize)
+    RHAPI.orderDB=tmp+'/orders.db'
+
+    replay=ReplayAdapter(a.fixture,a.latency,a.p401,a.p429)
+    API=RHAPI()
+    API.mount(replay)
+    config={'MT':'86400','DMT':'86400','NSD':'3.5','WATCH':a.watch,'TICKS':tmp+'/ticks'}
+    with redirect_stdout(io.StringIO()):
+        API.login('bench','bench')
+        sh=RHShell(config,API)
+        sh.algo.handleWatch('')
+        for x in a.stop:
+            sh.algo.handleStop(x)
+
+    print('{:<20}{:>10}{:>12}{:>12}{:>14}'.format('command','requests','median ms','max ms','peak KiB'))
+    tracemalloc.start()
+    for line in cmds:
+        times=[]
+        reqs=[]
+        peak=0
+        try:
+            for _ in range(a.n):
+                n=replay.count
+                tracemalloc.reset_peak()
+                base=tracemalloc.get_traced_memory()[0]
+                t=time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    run(sh,line)
+                times.append(time.perf_counter()-t)
+                peak=max(peak,tracemalloc.get_traced_memory()[1]-base)
+                reqs.append(replay.count-n)
+        except Exception as e:
+            print('{:<20}failed: {!r} (is it in the fixture?)'.format(line[:19],e))
+            continue
+        print('{:<20}{:>10}{:>12.1f}{:>12.1f}{:>14.1f}'.format(line[:19],max(reqs),1000*statistics.median(times),1000*max(times),peak/1024))
+    tracemalloc.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+from threading import Lock
+from collections import OrderedDict
+
+# Key/value store with per-entry expiry, saved to disk as json
+# so lookups survive shell restarts
+class DiskCache:
+
+    def __init__(self,path,ttl):
+        self.path=path
+        self.ttl=ttl
+        self.lock=Lock()
+        self.data={}
+        try:
+            with open(path) as f:
+                self.data=json.load(f)
+        except (OSError,ValueError):
+            pass
+
+    def get(self,k):
+        return self.getMany([k]).get(k)
+
+# Returns only the keys that are cached and unexpired
+    def getMany(self,ks):
+        now=time.time()
+        res={}
+        with self.lock:
+            for k in ks:
+                x=self.data.get(k)
+                if x is not None and now-x[1]<self.ttl:
+                    res[k]=x[0]
+        return res
+
+    def set(self,k,v):
+        self.update({k:v})
+
+    def update(self,dic):
+        if not dic:
+            return
+        now=time.time()
+        with self.lock:
+            self.data={k:x for k,x in self.data.items() if now-x[1]<self.ttl}
+            for k,v in dic.items():
+                self.data[k]=(v,now)
+            self.save()
+
+    def pop(self,k):
+        with self.lock:
+            self.data.pop(k,None)
+            self.save()
+
+# Writes to a temporary file first so a crash can't leave half a cache behind
+    def save(self):
+        d=os.path.dirname(self.path)
+        if d:
+            os.makedirs(d,exist_ok=True)
+        tmp=self.path+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.data,f)
+        os.replace(tmp,self.path)
+
+# Option contracts keyed by (chain_symbol, type, strike, expiration).
+# Contracts are pulled one (chain_symbol, expiration) group at a time,
+# and each group is refreshed on its own once it goes stale
+class OptionIndex:
+
+    def __init__(self,ttl):
+        self.ttl=ttl
+        self.lock=Lock()
+        self.contracts={}
+        self.pulls={}
+
+    @staticmethod
+    def key(o):
+        typ=o[1].upper()
+        typ='C' if typ in ['C','CALL'] else typ
+        typ='P' if typ in ['P','PUT'] else typ
+        strike=o[2] if o[2]=='X' else '{:.2f}'.format(float(o[2]))
+        return (o[0],typ,strike,o[3])
+
+    def fresh(self,symbol,exp):
+        now=time.time()
+        with self.lock:
+            return any(now-self.pulls.get(x,0)<self.ttl for x in [(symbol,exp),(symbol,'X')])
+
+# Replaces everything known about the group with the pulled instruments
+    def add(self,symbol,exp,instruments):
+        with self.lock:
+            old=self.contracts.get(symbol,{})
+            new={k:v for k,v in old.items() if exp!='X' and k[3]!=exp}
+            for x in instruments:
+                new[self.key([x['chain_symbol'],x['type'],x['strike_price'],x['expiration_date']])]=x
+            self.contracts[symbol]=new
+            self.pulls[(symbol,exp)]=time.time()
+
+# Any field of the query but the symbol may be X
+    def find(self,o):
+        q=self.key(o)
+        with self.lock:
+            return [v for k,v in self.contracts.get(q[0],{}).items()
+                if all(a=='X' or a==b for a,b in zip(q[1:],k[1:]))]
+
+# In-memory cache holding at most maxsize entries,
+# dropping the least recently used first
+class LRUCache:
+
+    def __init__(self,maxsize):
+        self.maxsize=maxsize
+        self.lock=Lock()
+        self.data=OrderedDict()
+
+    def get(self,k):
+        return self.getMany([k]).get(k)
+
+    def getMany(self,ks):
+        res={}
+        with self.lock:
+            for k in ks:
+                if k in self.data:
+                    self.data.move_to_end(k)
+                    res[k]=self.data[k]
+        return res
+
+    def set(self,k,v):
+        self.update({k:v})
+
+    def update(self,dic):
+        with self.lock:
+            for k,v in dic.items():
+                self.data[k]=v
+                self.data.move_to_end(k)
+            while len(self.data)>self.maxsize:
+                self.data.popitem(last=False)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import time
+from threading import Thread
+from util import shprint
+from metrics import tag
+
+# Order states after which nothing more will happen to an order
+DONE = ['filled','cancelled','rejected','failed']
+
+# Works a closing order for a triggered stop until it fills
+# The order is placed at the bid of the quote that triggered the stop
+# (the ask when buying back a short option), or at the stop price
+# without one, from the order the stop engine staged when there is one.
+# It is watched on its own, polled every fast seconds at first, backing
+# off to slow. steps times before the deadline, each gap twice the one
+# before, so the first comes about a second in with the defaults, it is
+# replaced at the current bid or ask: the order is cancelled, and once
+# the cancel is confirmed, whatever did not fill goes out again at the
+# new price. Only the engine's own order is ever touched, and there is
+# never more than one of them working. After the deadline the last
+# order is left working.
+class Executor:
+
+    def __init__(self,API,steps=5,deadline=60,fast=0.2,slow=2.0):
+        self.API = API
+        self.steps = steps
+        self.deadline = deadline
+        self.fast = fast
+        self.slow = slow
+
+    def close(self,pos,price,order=None,quote=None):
+        def dowork():
+            with tag('stops'):
+                try:
+                    self.work(pos,price,order,quote)
+                except Exception as e:
+                    shprint('Stop on {}: {}'.format(pos,e))
+        Thread(target=dowork,daemon=True).start()
+
+    def _place(self,flag,ins,o):
+        res=self.API._placeClose(flag,ins,o)
+        if not res or 'id' not in res:
+            raise Exception('order was not accepted: {}'.format(res))
+        return res
+
+# Polls the order until it is done or until passes
+    def _wait(self,order,opt,until):
+        wait=self.fast
+        while order['state'] not in DONE and time.time()<until:
+            time.sleep(min(wait,max(until-time.time(),0)))
+            wait=min(wait*1.5,self.slow)
+            order=self.API.getOrder(order['id'],opt) or order
+        return order
+
+# A cancel that is turned down is reported at once; the order has
+# usually filled in the meantime
+    def _cancel(self,order,opt):
+        if not self.API._cancel(order['id']):
+            order=self.API.getOrder(order['id'],opt) or order
+            if order['state'] not in DONE:
+                shprint('Could not cancel order {} to reprice it'.format(order['id']))
+            return order
+        return self._wait(order,opt,time.time()+10*self.slow)
+
+# From q, or from a quote fetched now
+    def _reprice(self,o,ins,q=None):
+        if q is None:
+            q=self.API.hub.get([ins],0)[0]
+        q=q or {}
+        p=q.get('bid_price') if o[1]=='sell' else q.get('ask_price')
+        return o[3] if p is None else '{:.2f}'.format(float(p))
+
+# order is a staged (flag, instrument URL, order) from API._closeOrder,
+# looked up now without one; quote is the one that triggered the stop,
+# the hub's latest snapshot without one
+    def work(self,pos,price,order=None,quote=None):
+        (flag,ins,o)=order or self.API._closeOrder(pos)
+        o[3]='{:.2f}'.format(price)
+        if o[2]==0:
+            shprint('Stop on {}: nothing left to close'.format(pos))
+            return
+        o[3]=self._reprice(o,ins,quote or self.API.hub.get([ins],self.API.hub.maxage)[0])
+        opt=not flag
+        shprint('Executing stop order on {} at {}\a'.format(pos,o[3]))
+        order=self._place(flag,ins,o)
+        start=time.time()
+        for step in range(1,self.steps+1):
+            order=self._wait(order,opt,start+self.deadline*(2**step-1)/(2**(self.steps+1)-1))
+            if order['state'] in DONE:
+                break
+            order=self._cancel(order,opt)
+            if order['state']!='cancelled':
+                break
+            done=float(order.get('cumulative_quantity') or order.get('processed_quantity') or 0)
+            left=float(order['quantity'])-done
+            if left<=0:
+                break
+            o[2]=int(left) if left==int(left) else left
+            o[3]=self._reprice(o,ins)
+            shprint('Repricing stop order on {} at {}'.format(pos,o[3]))
+            order=self._place(flag,ins,o)
+        order=self._wait(order,opt,start+self.deadline)
+        if order['state'] in DONE:
+            shprint('Stop order on {} {}'.format(pos,order['state']))
+        else:
+            shprint('Stop order on {} still working at {} after {}s'.format(pos,o[3],self.deadline))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import time
+import itertools
+from threading import Thread, Lock, Event
+from util import shprint
+from metrics import caller, tag
+from scheduler import Shed, PRIORITY, INTERACTIVE
+
+class Subscription:
+
+    def __init__(self,hub,sid):
+        self.hub=hub
+        self.sid=sid
+
+    def update(self,instruments):
+        self.hub.update(self.sid,instruments)
+
+    def cancel(self):
+        self.hub.unsubscribe(self.sid)
+
+# Shared quotes for every consumer, keyed by instrument URL
+# Subscribers are polled by one thread: each round quotes the due
+# subscribers' instruments in one batch per asset class and caller tag,
+# highest priority first, and hands every subscriber the quotes of its
+# own instruments. A background subscriber is never fetched under an
+# order tag, and its rounds can be shed on their own. Each subscriber
+# keeps to a fixed grid of its own interval. Every quote fetched is kept
+# as a snapshot, and get() answers from snapshots younger than maxage.
+# Callbacks run on the poller thread and should return quickly; the
+# quotes they get are shared and must not be modified.
+class QuoteHub:
+
+    def __init__(self,API,maxage=1.0):
+        self.API = API
+        self.maxage = maxage
+        self.lock = Lock()
+        self.snaps = {}
+        self.subs = {}
+        self.ids = itertools.count()
+        self.wake = Event()
+        self.thread = None
+
+# who is the metrics caller tag the subscriber's requests and callbacks
+# run under, which also sets their scheduler priority
+    def subscribe(self,instruments,interval,callback,who=None):
+        sid=next(self.ids)
+        with self.lock:
+            self.subs[sid]={
+                'ins':list(instruments),
+                'interval':interval,
+                'callback':callback,
+                'who':who or caller.get(),
+                'next':time.time()
+            }
+            if self.thread is None:
+                self.thread=Thread(target=self.run,daemon=True)
+                self.thread.start()
+        self.wake.set()
+        return Subscription(self,sid)
+
+    def update(self,sid,instruments):
+        with self.lock:
+            if sid in self.subs:
+                self.subs[sid]['ins']=list(instruments)
+
+    def unsubscribe(self,sid):
+        with self.lock:
+            self.subs.pop(sid,None)
+
+# Quotes the URLs in one batch per asset class and keeps them
+    def refresh(self,urls):
+        stocks=[x for x in urls if '/options/' not in x]
+        options=[x for x in urls if '/options/' in x]
+        res=(self.API.instrumentQuote(stocks) or [])+(self.API.instrumentQuote(options,True) or [])
+        now=time.time()
+        with self.lock:
+            for x in res:
+                if x:
+                    self.snaps[x['instrument']]=(now,x)
+        return {x['instrument']:x for x in res if x}
+
+# Quotes for the URLs, in order, None where there is no quote
+# Only snapshots older than maxage are fetched again
+    def get(self,urls,maxage=None):
+        if maxage is None:
+            maxage=self.maxage
+        now=time.time()
+        with self.lock:
+            res={x:self.snaps[x][1] for x in urls if x in self.snaps and now-self.snaps[x][0]<maxage}
+        stale=list(set(x for x in urls if x not in res))
+        if stale:
+            res.update(self.refresh(stale))
+        return [dict(res[x]) if x in res else None for x in urls]
+
+    def _round(self):
+        with self.lock:
+            now=time.time()
+            due=[x for x in self.subs.values() if x['next']<=now]
+            if not due:
+                return min([x['next'] for x in self.subs.values()],default=now+60)-now
+# Missed rounds are skipped, not made up
+            for x in due:
+                x['next']+=x['interval']*(int((now-x['next'])//x['interval'])+1)
+            due=[dict(x) for x in due]
+        snap={}
+        for who in sorted(set(x['who'] for x in due),key=lambda x: PRIORITY.get(x,INTERACTIVE)):
+            group=[x for x in due if x['who']==who]
+            urls=list(set(y for x in group for y in x['ins'])-set(snap))
+            try:
+                with tag(who):
+                    if urls:
+                        snap.update(self.refresh(urls))
+            except Shed:
+                continue
+            for x in group:
+                try:
+                    with tag(x['who']):
+                        x['callback']({y:snap[y] for y in x['ins'] if y in snap})
+                except Exception as e:
+                    shprint('Quote hub: {}'.format(e))
+        return 0
+
+    def run(self):
+        while True:
+            try:
+                wait=self._round()
+            except Exception as e:
+                shprint('Quote hub: {}'.format(e))
+                wait=1
+            if wait>0:
+                self.wake.wait(wait)
+                self.wake.clear()
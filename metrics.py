@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import contextvars
+from threading import Lock
+from contextlib import contextmanager
+from collections import defaultdict
+
+BASE = 'https://api.robinhood.com/'
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+# What a request is being made for: a shell command, the watch loop...
+# Set with tag(); carried into asyncio tasks and AsyncRHAPI's pool
+caller = contextvars.ContextVar('caller',default='other')
+
+@contextmanager
+def tag(name):
+    tok=caller.set(name)
+    try:
+        yield
+    finally:
+        caller.reset(tok)
+
+# Request counts, latency histograms, bytes and status codes per
+# logical endpoint and caller, fed by a response hook on the session
+# Endpoints are the keys of RHAPI.ep, prefixed with options/ when the
+# request went to the options API
+class Metrics:
+
+    def __init__(self,ep):
+        self.paths=sorted(((v,k) for k,v in ep.items()),key=lambda x: -len(x[0]))
+        self.lock=Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats=defaultdict(lambda: {
+                'count':0,
+                'seconds':0.0,
+                'buckets':[0]*len(BUCKETS),
+                'bytes':0,
+                'status':defaultdict(int)
+            })
+
+    def endpoint(self,url):
+        path=url.split('?')[0]
+        if not path.startswith(BASE):
+            return 'other'
+        path=path[len(BASE):]
+        pre=''
+        if path.startswith('options/'):
+            pre='options/'
+            path=path[len(pre):]
+        for (v,k) in self.paths:
+            if path.startswith(v):
+                return pre+k
+        return pre+'other'
+
+    def hook(self,res,*args,**kwargs):
+        sec=res.elapsed.total_seconds()
+        size=len(res.content or b'')
+        key=(self.endpoint(res.request.url),caller.get())
+        with self.lock:
+            x=self.stats[key]
+            x['count']+=1
+            x['seconds']+=sec
+            for i,b in enumerate(BUCKETS):
+                if sec<=b:
+                    x['buckets'][i]+=1
+                    break
+            x['bytes']+=size
+            x['status'][res.status_code]+=1
+
+# Rows of (endpoint, caller, count, errors, mean seconds, p95 seconds, bytes)
+# The p95 is the upper bound of the bucket it falls in
+    def summary(self):
+        res=[]
+        with self.lock:
+            for (ep,who),x in sorted(self.stats.items()):
+                errors=sum(n for s,n in x['status'].items() if s>=400)
+                seen=0
+                p95=float('inf')
+                for i,b in enumerate(BUCKETS):
+                    seen+=x['buckets'][i]
+                    if seen>=0.95*x['count']:
+                        p95=b
+                        break
+                res.append((ep,who,x['count'],errors,x['seconds']/x['count'],p95,x['bytes']))
+        return res
+
+# Prometheus text exposition format
+    def prometheus(self):
+        lines=[]
+        def labels(ep,who,**kw):
+            d=[('endpoint',ep),('caller',who)]+list(kw.items())
+            return '{'+','.join('{}="{}"'.format(k,v) for k,v in d)+'}'
+        with self.lock:
+            items=sorted(self.stats.items())
+            lines.append('# HELP rh_requests_total Requests sent to the API')
+            lines.append('# TYPE rh_requests_total counter')
+            for (ep,who),x in items:
+                for s,n in sorted(x['status'].items()):
+                    lines.append('rh_requests_total{} {}'.format(labels(ep,who,status=s),n))
+            lines.append('# HELP rh_request_seconds Time until response headers arrived')
+            lines.append('# TYPE rh_request_seconds histogram')
+            for (ep,who),x in items:
+                n=0
+                for i,b in enumerate(BUCKETS):
+                    n+=x['buckets'][i]
+                    lines.append('rh_request_seconds_bucket{} {}'.format(labels(ep,who,le=b),n))
+                lines.append('rh_request_seconds_bucket{} {}'.format(labels(ep,who,le='+Inf'),x['count']))
+                lines.append('rh_request_seconds_sum{} {}'.format(labels(ep,who),x['seconds']))
+                lines.append('rh_request_seconds_count{} {}'.format(labels(ep,who),x['count']))
+            lines.append('# HELP rh_response_bytes_total Response body bytes received')
+            lines.append('# TYPE rh_response_bytes_total counter')
+            for (ep,who),x in items:
+                lines.append('rh_response_bytes_total{} {}'.format(labels(ep,who),x['bytes']))
+        return '\n'.join(lines)+'\n'
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+import datetime
+from threading import Lock
+
+# Order states that can still change, asked for by the first sync
+OPEN = ['queued','unconfirmed','confirmed','partially_filled']
+
+# Local copy of the account's orders, kept current from the server's
+# updated_at cursor
+# The first sync of an account asks the server for its open orders
+# only, and starts the cursor a few minutes before it was sent. Every
+# later sync asks only for orders updated since the cursor, which picks
+# up open orders closing. Open orders are the ones that can still be
+# cancelled, and are looked up through an index, however long the
+# history.
+class OrderStore:
+
+    def __init__(self,path):
+        self.lock=Lock()
+        os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+        self.db=sqlite3.connect(path,check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS orders (
+                    id TEXT PRIMARY KEY,
+                    account TEXT,
+                    opt INTEGER,
+                    open INTEGER,
+                    created_at TEXT,
+                    updated_at TEXT,
+                    data TEXT);
+                CREATE INDEX IF NOT EXISTS pending ON orders (account,opt,open);
+                CREATE TABLE IF NOT EXISTS cursors (
+                    account TEXT,
+                    opt INTEGER,
+                    updated_at TEXT,
+                    PRIMARY KEY (account,opt));
+            ''')
+
+# updated_at to sync from, None before the first sync
+    def cursor(self,account,opt):
+        with self.lock:
+            row=self.db.execute('SELECT updated_at FROM cursors WHERE account=? AND opt=?',(account,int(opt))).fetchone()
+        return row[0] if row else None
+
+# Cursor for a first sync about to be sent, with room for clock skew
+    @staticmethod
+    def start(skew=300):
+        since=datetime.datetime.now(datetime.timezone.utc)-datetime.timedelta(seconds=skew)
+        return since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# Stores orders, keeping whichever copy of each was updated last
+# With synced, they are a sync's results and move the cursor forward,
+# to since at least
+# A since marks the first sync, whose results are every open order: an
+# order stored as open before that which is not among them has closed
+# out of the cursor's reach, and is marked closed
+    def add(self,account,opt,orders,synced=False,since=''):
+        key='cancel_url' if opt else 'cancel'
+        rows=[(x['id'],account,int(opt),int(x.get(key) is not None),x.get('created_at'),x.get('updated_at') or '',json.dumps(x))
+            for x in orders if x and 'id' in x]
+        with self.lock, self.db:
+            self.db.executemany('''
+                INSERT INTO orders VALUES (?,?,?,?,?,?,?)
+                ON CONFLICT(id) DO UPDATE SET open=excluded.open, updated_at=excluded.updated_at, data=excluded.data
+                WHERE excluded.updated_at>=orders.updated_at
+            ''',rows)
+            if synced and since:
+                ids=set(x[0] for x in rows)
+                stale=self.db.execute('SELECT id FROM orders WHERE account=? AND opt=? AND open=1 AND updated_at<?',(account,int(opt),since)).fetchall()
+                self.db.executemany('UPDATE orders SET open=0 WHERE id=?',[x for x in stale if x[0] not in ids])
+            cur=max([since]+[x[5] for x in rows])
+            if synced and cur:
+                self.db.execute('''
+                    INSERT INTO cursors VALUES (?,?,?)
+                    ON CONFLICT(account,opt) DO UPDATE SET updated_at=max(updated_at,excluded.updated_at)
+                ''',(account,int(opt),cur))
+
+    def pending(self,account,opt):
+        with self.lock:
+            rows=self.db.execute('SELECT data FROM orders WHERE account=? AND opt=? AND open=1 ORDER BY created_at DESC',(account,int(opt))).fetchall()
+        return [json.loads(x[0]) for x in rows]
+
+    def kind(self,ID):
+        with self.lock:
+            row=self.db.execute('SELECT opt FROM orders WHERE id=?',(ID,)).fetchone()
+        return None if row is None else bool(row[0])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import time
+import datetime
+import numpy as np
+from zoneinfo import ZoneInfo
+
+# Risk-free rate used for every contract, roughly the short T-bill yield
+RATE = 0.04
+
+# Options expire at the close in New York, wherever this runs
+EASTERN = ZoneInfo('America/New_York')
+
+# Normal CDF through Abramowitz & Stegun 26.2.17 (error below 1e-7),
+# since numpy has no erf
+def _ncdf(x):
+    t=1/(1+0.2316419*np.abs(x))
+    poly=t*(0.319381530+t*(-0.356563782+t*(1.781477937+t*(-1.821255978+t*1.330274429))))
+    tail=_npdf(x)*poly
+    return np.where(x>=0,1-tail,tail)
+
+def _npdf(x):
+    return np.exp(-0.5*x*x)/np.sqrt(2*np.pi)
+
+def _d1d2(S,K,T,sigma,r):
+    v=sigma*np.sqrt(T)
+    d1=(np.log(S/K)+(r+0.5*sigma*sigma)*T)/v
+    return (d1,d1-v)
+
+# Years from now until 16:00 New York time on each expiration date, at
+# least a minute
+def years(dates):
+    now=time.time()
+    ts=[datetime.datetime.strptime(x,'%Y-%m-%d').replace(hour=16,tzinfo=EASTERN).timestamp() for x in dates]
+    return np.maximum((np.array(ts)-now)/(365*86400),60/(365*86400))
+
+# Black-Scholes price; put is a boolean array
+def price(S,K,T,sigma,put,r=RATE):
+    (d1,d2)=_d1d2(S,K,T,sigma,r)
+    df=np.exp(-r*T)
+    call=S*_ncdf(d1)-K*df*_ncdf(d2)
+    return np.where(put,call-S+K*df,call)
+
+# Delta, gamma, theta per calendar day and vega per volatility point,
+# the units Robinhood reports them in
+def greeks(S,K,T,sigma,put,r=RATE):
+    (d1,d2)=_d1d2(S,K,T,sigma,r)
+    df=np.exp(-r*T)
+    pdf=_npdf(d1)
+    sq=np.sqrt(T)
+    delta=np.where(put,_ncdf(d1)-1,_ncdf(d1))
+    gamma=pdf/(S*sigma*sq)
+    decay=-S*pdf*sigma/(2*sq)
+    theta=np.where(put,decay+r*K*df*_ncdf(-d2),decay-r*K*df*_ncdf(d2))/365
+    vega=S*pdf*sq/100
+    return {'delta':delta,'gamma':gamma,'theta':theta,'vega':vega}
+
+# Implied volatility of every contract at once
+# Newton steps kept inside a bisection bracket, so contracts where
+# vega vanishes still converge. Prices outside the no-arbitrage bounds
+# give NaN.
+def impliedVol(P,S,K,T,put,r=RATE,lo=1e-4,hi=5.0,iters=40,tol=1e-6):
+    (P,S,K,T,put)=np.broadcast_arrays(*[np.asarray(x,dtype=float) for x in (P,S,K,T,put)])
+    put=put.astype(bool)
+    df=np.exp(-r*T)
+    floor=np.where(put,np.maximum(K*df-S,0),np.maximum(S-K*df,0))
+    cap=np.where(put,K*df,S)
+    ok=(P>floor)&(P<cap)&(S>0)&(K>0)
+    a=np.full(P.shape,lo)
+    b=np.full(P.shape,hi)
+    sigma=np.full(P.shape,0.5)
+    with np.errstate(all='ignore'):
+        for _ in range(iters):
+            f=price(S,K,T,sigma,put,r)-P
+            a=np.where(f<0,sigma,a)
+            b=np.where(f>0,sigma,b)
+            vega=S*_npdf(_d1d2(S,K,T,sigma,r)[0])*np.sqrt(T)
+            step=sigma-f/vega
+            bad=~np.isfinite(step)|(step<=a)|(step>=b)
+            sigma=np.where(bad,0.5*(a+b),step)
+            if np.all(~ok|(np.abs(f)<tol)):
+                break
+    return np.where(ok,sigma,np.nan)
+
+def _num(x):
+    return np.nan if x in [None,''] else float(x)
+
+# Fills in greeks and implied volatility on option quotes from
+# RHAPI.optionQuote(..., ul=True), as (quote, instrument) pairs
+# Quotes the API left without a delta get everything computed from the
+# mark; with force, every quote is recomputed from its volatility and
+# current underlying_price, which needs no market-data request
+def fillGreeks(pairs,force=False):
+    pairs=[(a,b) for (a,b) in pairs if a and a.get('underlying_price') is not None]
+    if not force:
+        pairs=[(a,b) for (a,b) in pairs if a['delta'] in [None,'']]
+    if pairs==[]:
+        return
+    S=np.array([a['underlying_price'] for (a,b) in pairs],dtype=float)
+    K=np.array([float(b['strike_price']) for (a,b) in pairs])
+    T=years([b['expiration_date'] for (a,b) in pairs])
+    put=np.array([b['type']=='put' for (a,b) in pairs])
+    iv=np.array([_num(a.get('implied_volatility')) for (a,b) in pairs])
+    P=np.array([_num(a['adjusted_mark_price']) for (a,b) in pairs])
+    miss=np.isnan(iv)
+    if miss.any():
+        iv[miss]=impliedVol(P[miss],S[miss],K[miss],T[miss],put[miss])
+    with np.errstate(all='ignore'):
+        g=greeks(S,K,T,iv,put)
+    g['implied_volatility']=iv
+    for i,(a,b) in enumerate(pairs):
+        if np.isnan(iv[i]):
+            continue
+        for k in g:
+            a[k]='{:.6f}'.format(g[k][i])
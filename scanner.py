@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import time
+import datetime
+import numpy as np
+from threading import Lock
+from api import _rebuildOption
+from pricing import fillGreeks
+
+# Scores whole option chains at once
+# A snapshot is every contract of an underlying's nearest maxexp
+# expirations, quoted and laid out as arrays. Snapshots are kept for
+# ttl seconds, so scans that follow each other reuse the same quotes.
+class ChainScanner:
+
+    def __init__(self,API,ttl=15,maxexp=4):
+        self.API = API
+        self.ttl = ttl
+        self.maxexp = maxexp
+        self.lock = Lock()
+        self.snaps = {}
+
+# Only the expirations that are scored are pulled, listed first by
+# the chains endpoint
+    def _contracts(self,symbols):
+        today=datetime.date.today().isoformat()
+        exps=self.API.getExpirations(symbols) or {}
+        qs=[[x,'X','X',y] for x in symbols for y in [z for z in exps.get(x,[]) if z>=today][:self.maxexp]]
+        info=(self.API.getOptionID(qs,True) or []) if qs else []
+        res={x:[] for x in symbols}
+        for x in info:
+            if x['expiration_date']>=today and x['chain_symbol'] in res:
+                res[x['chain_symbol']].append(x)
+        for x in res:
+            exps=sorted(set(y['expiration_date'] for y in res[x]))[:self.maxexp]
+            res[x]=[y for y in res[x] if y['expiration_date'] in exps]
+        return res
+
+    def _pull(self,symbols):
+        contracts=self._contracts(symbols)
+        info=[y for x in symbols for y in contracts[x]]
+        quotes=self.API.instrumentQuote([x['url'] for x in info],True) or []
+        quotes={x['instrument']:x for x in quotes if x}
+        under=self.API.stockQuote(symbols) or []
+        under={x['symbol']:float(x['last_trade_price']) for x in under if x}
+        now=time.time()
+        for sym in symbols:
+            l=[(x,quotes[x['url']]) for x in contracts[sym] if x['url'] in quotes]
+            for (b,a) in l:
+                a['underlying_price']=under.get(sym)
+            fillGreeks([(a,b) for (b,a) in l])
+            def col(f):
+                return np.array([f(b,a) for (b,a) in l],dtype=float)
+            def num(x):
+                return np.nan if x is None else float(x)
+            snap={
+                'info':[b for (b,a) in l],
+                'quote':[a for (b,a) in l],
+                'put':col(lambda b,a: b['type']=='put'),
+                'strike':col(lambda b,a: float(b['strike_price'])),
+                'mark':col(lambda b,a: num(a['adjusted_mark_price'])),
+                'bid':col(lambda b,a: num(a['bid_price'])),
+                'ask':col(lambda b,a: num(a['ask_price'])),
+                'delta':col(lambda b,a: num(a['delta'])),
+                'oi':col(lambda b,a: num(a.get('open_interest'))),
+                'ul':np.full(len(l),under.get(sym,np.nan))
+            }
+            with self.lock:
+                self.snaps[sym]=(now,snap)
+
+    def snapshot(self,symbols):
+        now=time.time()
+        with self.lock:
+            stale=[x for x in symbols if now-self.snaps.get(x,(0,))[0]>=self.ttl]
+        if stale:
+            self._pull(stale)
+        with self.lock:
+            return {x:self.snaps[x][1] for x in symbols if x in self.snaps}
+
+# Top k contracts per underlying and side by |UL*delta/mark|
+# Deltas the API left out are computed locally at snapshot time
+# Keeps contracts with mark above minmark, open interest of at least
+# minoi, and a bid/ask spread of at most maxspread times the mark
+# Returns {'<symbol> <C/P>': [(option string, quote), ...]}, best first
+    def scan(self,symbols,k=1,minmark=0.4,minoi=0,maxspread=None):
+        snaps=self.snapshot(list(set(symbols)))
+        syms=[x for x in snaps if len(snaps[x]['mark'])]
+        if syms==[]:
+            return {}
+        def cat(f):
+            return np.concatenate([snaps[x][f] for x in syms])
+        (mark,bid,ask,delta,oi,ul,put)=[cat(x) for x in ['mark','bid','ask','delta','oi','ul','put']]
+        sym=np.concatenate([np.full(len(snaps[x]['mark']),i) for i,x in enumerate(syms)])
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            score=np.abs(ul*delta/mark)
+# A quote without open interest only fails a positive minimum
+            keep=(mark>minmark) & ((oi>=minoi) | (np.isnan(oi) & (minoi<=0))) & np.isfinite(score)
+            if maxspread is not None:
+                keep&=(ask-bid)<=maxspread*mark
+
+        group=2*sym+put.astype(int)
+        idx=np.flatnonzero(keep)
+        idx=idx[np.lexsort((-score[idx],group[idx]))]
+        g=group[idx]
+        first=np.r_[0,np.flatnonzero(np.diff(g))+1]
+        rank=np.arange(len(idx))-np.repeat(first,np.diff(np.r_[first,len(idx)]))
+        idx=idx[rank<k]
+
+        info=[y for x in syms for y in snaps[x]['info']]
+        quote=[y for x in syms for y in snaps[x]['quote']]
+        res={}
+        for i in idx:
+            a=quote[i]
+            a['pd']=float(score[i])
+            res.setdefault(syms[sym[i]]+' '+('P' if put[i] else 'C'),[]).append((_rebuildOption(info[i]),a))
+        return res
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import itertools
+from threading import Condition, Event
+from metrics import caller
+
+# Priority classes, most urgent first
+ORDER = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+
+# Priority of requests made under a metrics caller tag
+# Shell commands and untagged callers are interactive, and anything
+# sent to an orders endpoint is an order whoever sends it
+# The chain scan behind a watch alert is interactive: it has already
+# rung the bell, and the user is waiting on it
+PRIORITY = {'stops':ORDER,'watch':BACKGROUND,'alert':INTERACTIVE}
+
+# (requests per second, burst) per endpoint family
+# Orders can burst high enough for cancelAll to flatten everything at once
+BUDGET = {
+    'orders':(2.0,40),
+    'marketdata':(5.0,20),
+    'other':(5.0,20)
+}
+
+# Raised instead of sending a background request while its family's
+# budget is tight or backing off; the caller should skip this round
+class Shed(Exception):
+    pass
+
+def family(url):
+    path=url.split('?')[0]
+    if '/orders/' in path:
+        return 'orders'
+    if '/marketdata/' in path:
+        return 'marketdata'
+    return 'other'
+
+class _Bucket:
+
+    def __init__(self,rate,burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=float(burst)
+        self.stamp=time.monotonic()
+        self.until=0
+        self.waiting=[]
+
+    def refill(self,now):
+        self.tokens=min(self.burst,self.tokens+(now-self.stamp)*self.rate)
+        self.stamp=now
+
+class _Flight:
+
+    def __init__(self):
+        self.done=Event()
+        self.res=None
+        self.err=None
+
+# Token bucket per endpoint family, granted in priority order
+# Waiting requests of a family queue by (priority, arrival), so an order
+# goes out before any quote poll queued ahead of it. Background requests
+# never queue: they are shed while the bucket is below reserve*burst,
+# others are waiting, or the family is backing off from a 429.
+# Identical GETs share the response of the one already in flight.
+class Scheduler:
+
+    def __init__(self,budget=BUDGET,reserve=0.25,retries=3):
+        self.buckets={k:_Bucket(*v) for k,v in budget.items()}
+        self.reserve=reserve
+        self.retries=retries
+        self.cond=Condition()
+        self.seq=itertools.count()
+        self.inflight={}
+
+    def priority(self,fam):
+        if fam=='orders':
+            return ORDER
+        return PRIORITY.get(caller.get(),INTERACTIVE)
+
+    def acquire(self,fam,prio):
+        b=self.buckets[fam]
+        with self.cond:
+            now=time.monotonic()
+            b.refill(now)
+            if prio==BACKGROUND and (now<b.until or b.waiting or b.tokens<1+self.reserve*b.burst):
+                raise Shed('Background request to {} shed'.format(fam))
+            me=(prio,next(self.seq))
+            heapq.heappush(b.waiting,me)
+            try:
+                while True:
+                    now=time.monotonic()
+                    b.refill(now)
+                    if b.waiting[0]!=me:
+                        self.cond.wait()
+                    elif now<b.until:
+                        self.cond.wait(b.until-now)
+                    elif b.tokens<1:
+                        self.cond.wait((1-b.tokens)/b.rate)
+                    else:
+                        b.tokens-=1
+                        return
+            finally:
+                b.waiting.remove(me)
+                heapq.heapify(b.waiting)
+                self.cond.notify_all()
+
+# Holds the whole family back for Retry-After seconds, or an
+# exponential guess when the header is missing
+    def backoff(self,fam,res,attempt):
+        try:
+            delay=float(res.headers.get('Retry-After'))
+        except (TypeError,ValueError):
+            delay=2**attempt
+        b=self.buckets[fam]
+        with self.cond:
+            b.until=max(b.until,time.monotonic()+delay)
+            self.cond.notify_all()
+
+# Sends through fn() once the budget allows, retrying 429s after the
+# backoff. key, for GETs, identifies requests that can share a response;
+# a request is shared from when it is first sent until its final answer.
+    def send(self,url,fn,key=None):
+        fam=family(url)
+        prio=self.priority(fam)
+        if key is not None:
+            with self.cond:
+                f=self.inflight.get(key)
+# A shed background request leaves others to send their own
+            if f is not None:
+                f.done.wait()
+                if f.err is None:
+                    return f.res
+                if not isinstance(f.err,Shed):
+                    raise f.err
+        self.acquire(fam,prio)
+        f=_Flight()
+        if key is not None:
+            with self.cond:
+                self.inflight.setdefault(key,f)
+        try:
+            for attempt in range(self.retries+1):
+                if attempt:
+                    self.acquire(fam,prio)
+                f.res=fn()
+                if f.res.status_code!=429:
+                    break
+                self.backoff(fam,f.res,attempt)
+                if prio==BACKGROUND:
+                    raise Shed('Background request to {} shed'.format(fam))
+            return f.res
+        except Exception as e:
+            f.err=e
+            raise e
+        finally:
+            if key is not None:
+                with self.cond:
+                    if self.inflight.get(key) is f:
+                        del self.inflight[key]
+            f.done.set()
@@ -4,10 +4,11 @@ import cmd, readline
 import shlex
 from terminaltables import AsciiTable
 from colorclass import Color
-from api import RHAPI
+from api import RHAPI, BURST
+from transport import RecordAdapter
+from metrics import caller, tag
 from algo import RHAlgo
 from util import sigint, shprint
-from discordTracker import RHDiscord
 from threading import Thread
 
 def errorDec(func):
@@ -71,7 +72,7 @@ def _squoteformat(rawdat):
             ])
     print(tabl.table)
 
-def _oquoteformat(rawdat,API):
+def _oquoteformat(rawdat):
     if rawdat is None:
         return
     dat=[]
@@ -82,8 +83,6 @@ def _oquoteformat(rawdat,API):
         jdic[a]='center'
     tabl.justify_columns=jdic
 
-    underlying={}
-
     for a,b in rawdat:
         try:
             if float(a['adjusted_mark_price'])>float(b['min_ticks']['cutoff_price']):
@@ -94,9 +93,7 @@ def _oquoteformat(rawdat,API):
             print("Robinhood claims that an instrument exists, but has no data for it.")
             continue
 
-        if b['chain_symbol'] not in underlying:
-            underlying[b['chain_symbol']]=float(API.stockQuote([b['chain_symbol']])[0]['last_trade_price'])
-        UL=underlying[b['chain_symbol']]
+        UL=a['underlying_price']
 
         tmp=float(a['delta']) if a['delta'] else 1.0
         PD=_cf(abs(UL*tmp/float(a['adjusted_mark_price'])))
@@ -136,6 +133,8 @@ def _orderformat(rawdat,API):
     
     (s,o)=rawdat
 
+    API.getInstruments([a['instrument'] for a in s]+[l['option'] for a in o for l in a['legs']])
+
     for a in s:
         info=API.getInstrumentInfo(a['instrument'])
         typ=a['type'] if a['trigger']=='immediate' else 'stop'
@@ -189,8 +188,8 @@ def _portformat(rawdat,API):
     tvs=0
 
     for a in s:
-        info=API.getInstrumentInfo(a['instrument'])
-        quote=API.stockQuote([info])[0]
+        info=a['symbol']
+        quote=a['quote']
         tc = float(a['quantity'])*float(a['average_buy_price'])
         tv = float(a['quantity'])*float(quote['bid_price'])
         tvs+=tv
@@ -205,8 +204,8 @@ def _portformat(rawdat,API):
             a['url'].split('/')[-2]
         ])
     for a in o:
-        info=API.getInstrumentInfo(a['option'])
-        quote=next(API.optionQuote([info]))[0]
+        info=a['symbol']
+        quote=a['quote']
         tc = float(a['quantity'])*float(a['average_price'])
         tv = float(a['quantity'])*float(quote['bid_price'])*float(a['trade_value_multiplier'])
         tvs+=tv
@@ -227,6 +226,25 @@ def _portformat(rawdat,API):
     dat.append(['Total','','',_cf(dep),_cf(tot),_autocolor(_cf(tot-dep)),_autocolor(_cfp(tot/dep-1))])
     print(tabl.table)
 
+def _stopformat(rawdat):
+    if rawdat == []:
+        return
+    dat=[]
+    tabl=AsciiTable(dat,'-'+_color('Stop Orders','blue'))
+    dat.append(["Symbol","Stop","Position ID"])
+    jdic={}
+    for a in range(len(dat[0])):
+        jdic[a]='center'
+    tabl.justify_columns=jdic
+
+    for (pos,info,price) in rawdat:
+        dat.append([
+            info,
+            _color(_cf(price),'red'),
+            pos
+        ])
+    print(tabl.table)
+
 def _watchformat(rawdat,API):
     if rawdat=={}:
         return
@@ -261,27 +279,72 @@ def _watchformat(rawdat,API):
         ])
     print(tabl.table)
 
+def _statsformat(rawdat):
+    if rawdat == []:
+        return
+    dat=[]
+    tabl=AsciiTable(dat,'-'+_color('Requests','blue'))
+    dat.append(["Endpoint","Caller","Count","Errors","Mean ms","p95 ms","KiB"])
+    jdic={}
+    for a in range(len(dat[0])):
+        jdic[a]='center'
+    tabl.justify_columns=jdic
+
+    for (ep,who,n,err,mean,p95,size) in rawdat:
+        dat.append([
+            ep,
+            who,
+            n,
+            _color(err,'red') if err else err,
+            '{:.1f}'.format(1000*mean),
+            '{:.0f}'.format(1000*p95),
+            '{:.1f}'.format(size/1024)
+        ])
+    print(tabl.table)
+
 class RHShell(cmd.Cmd):
     intro = 'This is a Robinhood shell. Type help for help.\n'
     prompt = '> '
     config = {}
     
-    def __init__(self):
+# config and API are for running the shell without a config file
+# or a live login, as bench.py does
+    def __init__(self,config=None,API=None):
         cmd.Cmd.__init__(self)
 
-        with open('config') as c:
-            for l in c:
-                x=shlex.split(l)
-                self.config[x[0]]=x[1]
+        if config is None:
+            with open('config') as c:
+                for l in c:
+                    x=shlex.split(l)
+                    self.config[x[0]]=x[1]
+        else:
+            self.config=config
 
+# discordTracker pulls in the whole discord library, so it is only
+# imported if the tracker is turned on
+        #from discordTracker import RHDiscord
         #Thread(target=lambda: RHDiscord(),daemon=True).start()
 
-        self.API = RHAPI()
-        self.API.login(self.config['RHID'],self.config['RHPWD'])
+        if API is None:
+            conc=int(self.config.get('CONC',8))
+            API = RHAPI(conc)
+            if 'RECORD' in self.config:
+                API.mount(RecordAdapter(self.config['RECORD'],pool_connections=conc,pool_maxsize=max(conc,BURST)))
+            API.login(self.config['RHID'],self.config['RHPWD'],self.config.get('SESSION','cache/session.json'))
+        self.API = API
 
         self.algo = RHAlgo(self,self.API,self.config)
         Thread(target=lambda: self.algo.listen(),daemon=True).start()
 
+# Requests a command makes are counted under shell:<command>, unless
+# it was sent by something already tagged, like the stop engine
+    def onecmd(self,line):
+        name=self.parseline(line)[0]
+        if caller.get()!='other' or not name:
+            return cmd.Cmd.onecmd(self,line)
+        with tag('shell:'+name):
+            return cmd.Cmd.onecmd(self,line)
+
     @errorDec
     def recvcmd(self,line):
         lc=self.lastcmd
@@ -308,7 +371,7 @@ class RHShell(cmd.Cmd):
             else:
                 options.append(parts)
         _squoteformat(self.API.stockQuote(stocks))
-        _oquoteformat(self.API.optionQuote(options),self.API)
+        _oquoteformat(self.API.optionQuote(options,True))
 
     @errorDec
     def do_o(self,line):
@@ -387,6 +450,20 @@ class RHShell(cmd.Cmd):
             price = _cf(float(pq[0])*perc)
         self.algo.handleStop('{}'.format(ments[0]+' '+price))
 
+    @errorDec
+    def do_ls(self,line):
+        'Lists armed stop orders'
+        _stopformat(self.algo.handleListStops())
+
+    @errorDec
+    def do_S(self,line):
+        'Disarms stop orders. S <ID> [<limit>]'
+        if len(shlex.split(line))==0:
+            print('No arguments provided')
+            return
+        for (pos,price) in self.algo.handleDisarm(line):
+            print('Stop order on {} at {} disarmed.'.format(pos,_cf(price)))
+
     @errorDec
     def do_w(self,line):
         'Adds instruments to watchlist'
@@ -398,7 +475,10 @@ class RHShell(cmd.Cmd):
     def do_cw(self,line):
         'Checks status of instruments off the watchlist'
         ments=shlex.split(line)
-        Thread(target=lambda: self.algo.handleCW(flags=ments),daemon=True).start()
+        def dowork():
+            with tag('shell:cw'):
+                self.algo.handleCW(flags=ments)
+        Thread(target=dowork,daemon=True).start()
 #        self.algo.handleCW(flags=ments)
 #        self.do_payload('cw None algo')
         pass
@@ -411,15 +491,41 @@ class RHShell(cmd.Cmd):
     def handleCW(self,data):
         _watchformat(data,self.API)
     
+    @errorDec
+    def do_stats(self,line):
+        'Request counts, latency and sizes per endpoint and caller. stats [prom [<file>] | reset]'
+        args=shlex.split(line)
+        if args==[]:
+            _statsformat(self.API.metrics.summary())
+        elif args[0]=='prom':
+            text=self.API.metrics.prometheus()
+            if len(args)>1:
+                with open(args[1],'w') as f:
+                    f.write(text)
+            else:
+                print(text,end='')
+        elif args[0]=='reset':
+            self.API.metrics.reset()
+        else:
+            print('Unknown option {}'.format(args[0]))
+
     @errorDec
     def do_exit(self,line):
         'Exit shell'
         self.exit()
         return True
 
+    @errorDec
+    def do_logout(self,line):
+        'Logs out, forgetting the saved session, and exits shell'
+        self.API.logout()
+        return True
+
+# A saved session is left valid for the next launch
     def exit(self):
 # TO-DO: Close other services
-        self.API.logout()
+        if self.API.sessionFile is None:
+            self.API.logout()
 
 def main():
     rs=RHShell()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import time
+from bisect import insort, bisect_right
+from threading import Lock, Thread
+from util import shprint
+from metrics import tag
+
+# Watches every armed stop through one quote hub subscription
+# Stops are kept per instrument, sorted by price, so a tick is one
+# bisect per instrument, however many stops are armed
+# Each armed position also has its closing order staged, as returned by
+# API._closeOrder, so firing a stop needs no lookups: fire(pos, price,
+# order, quote) gets everything but the price, and the quote that
+# triggered the stop to price it from. Staged orders follow every
+# positions list the API fetches, and the engine fetches them itself
+# every refresh seconds while stops are armed.
+class StopEngine:
+
+    def __init__(self,API,interval,fire,refresh=30):
+        self.API = API
+        self.interval = interval
+        self.fire = fire
+        self.refresh = refresh
+        self.lock = Lock()
+        self.book = {}
+        self.info = {}
+        self.staged = {}
+        self.sub = None
+        self.fresh = time.time()
+        API.watchPositions(self.update)
+
+# Returns False if the stop is already armed
+    def arm(self,pos,price):
+        with self.lock:
+            known=pos in self.info
+            if known:
+                (info,staged)=(self.info[pos],self.staged[pos])
+        if not known:
+            (res,flag)=self.API.getPosition(pos)
+            staged=self.API._closeFrom(res,flag)
+            (flag,ins,o)=staged
+            info=(ins,flag,o[0] if flag else ' '.join(o[0]))
+        with self.lock:
+            l=self.book.setdefault(info[0],[])
+            if (price,pos) in l:
+                return False
+            insort(l,(price,pos))
+            self.info.setdefault(pos,info)
+            self.staged.setdefault(pos,staged)
+            self._subscribe()
+        return True
+
+# Restages the armed positions of one asset class from a list of its
+# open positions; armed positions missing from it have nothing left
+    def update(self,positions,opt):
+        positions={x['url'].split('/')[-2]:x for x in positions}
+        with self.lock:
+            for (pos,(flag,ins,o)) in list(self.staged.items()):
+                if flag==opt:
+                    continue
+                if pos in positions:
+                    self.staged[pos]=self.API._closeFrom(positions[pos],flag)
+                else:
+                    self.staged[pos]=(flag,ins,o[:2]+[0,o[3]])
+
+# Without a price, disarms every stop on the position
+# Returns the (position, price) pairs that were removed
+    def disarm(self,pos,price=None):
+        with self.lock:
+            if pos not in self.info:
+                return []
+            ins=self.info[pos][0]
+            gone=[x for x in self.book[ins] if x[1]==pos and (price is None or x[0]==price)]
+            self.book[ins]=[x for x in self.book[ins] if x not in gone]
+            self._prune(ins)
+        return [(x[1],x[0]) for x in gone]
+
+    def list(self):
+        with self.lock:
+            return sorted((pos,self.info[pos][2],price) for l in self.book.values() for (price,pos) in l)
+
+    def _prune(self,ins):
+        if self.book[ins]==[]:
+            del self.book[ins]
+        left=set(x[1] for l in self.book.values() for x in l)
+        for pos in [x for x in self.info if x not in left]:
+            del self.info[pos]
+            del self.staged[pos]
+        self._subscribe()
+
+# Keeps the subscription on the instruments in the book
+    def _subscribe(self):
+        ins=list(self.book)
+        if self.sub is None and ins:
+            self.sub=self.API.subscribe(ins,self.interval,self.tick,'stops')
+        elif self.sub is not None and not ins:
+            self.sub.cancel()
+            self.sub=None
+        elif self.sub is not None:
+            self.sub.update(ins)
+
+# Pops and returns the stops that quote has gone through, each with
+# its position's staged order
+    def _triggered(self,ins,price):
+        l=self.book.get(ins,[])
+        i=bisect_right(l,(price,chr(0x10ffff)))
+        res=[(p,pos,self.staged[pos]) for (p,pos) in l[i:]]
+        if res:
+            del l[i:]
+            self._prune(ins)
+        return res
+
+    def _refresh(self):
+        with self.lock:
+            kinds=set(x[1] for x in self.info.values())
+        with tag('stops'):
+            for flag in kinds:
+                try:
+                    self.API._positions(not flag)
+                except Exception as e:
+                    shprint('Stop positions: {}'.format(e))
+
+# quotes is {instrument URL: quote}; without it, the book is quoted now
+    def tick(self,quotes=None):
+        if quotes is None:
+            with self.lock:
+                ins=list(self.book)
+            quotes={x:y for (x,y) in zip(ins,self.API.hub.get(ins,0)) if y}
+        if time.time()-self.fresh>self.refresh:
+            self.fresh=time.time()
+            Thread(target=self._refresh,daemon=True).start()
+        fired=[]
+        with self.lock:
+            for (ins,x) in quotes.items():
+                if ins not in self.book:
+                    continue
+                p=x['last_trade_price'] if self.info[self.book[ins][0][1]][1] else x['bid_price']
+                if p is not None:
+                    fired.extend(y+(x,) for y in self._triggered(ins,float(p)))
+        for (price,pos,(flag,ins,o),quote) in fired:
+            self.fire(pos,price,(flag,ins,list(o)),quote)
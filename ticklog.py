@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import glob
+import time
+import numpy as np
+from threading import Lock
+
+# Append-only tick history on disk, one memory-mapped segment at a time
+# A segment is a (3, cap) float64 .npy file whose rows are the columns
+# timestamp, instrument and price. Instruments are indices into
+# names.json. Unwritten slots have a NaN timestamp, which is written
+# last, so a tick is either fully there or not at all. Once a segment
+# fills up the next one is started, and segments whose newest tick is
+# more than days days old are removed. A segment is 24 MiB at the
+# default cap; 100 symbols every 5 seconds fill under 2 a day while the
+# loop runs around the clock.
+class TickLog:
+
+    def __init__(self,path='cache/ticks',cap=1<<20,days=30):
+        self.path=path
+        self.cap=cap
+        self.days=days
+        self.lock=Lock()
+        os.makedirs(path,exist_ok=True)
+        try:
+            with open(os.path.join(path,'names.json')) as f:
+                self.names=json.load(f)
+        except (OSError,ValueError):
+            self.names=[]
+        self.ids={x:i for i,x in enumerate(self.names)}
+        segs=self.segments()
+        if segs:
+            self.seg=np.load(segs[-1],mmap_mode='r+')
+            self.n=self._count(self.seg)
+            self.num=int(os.path.basename(segs[-1]).split('.')[0])
+        else:
+            self.num=-1
+            self._rotate()
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.path,'*.npy')))
+
+    @staticmethod
+    def _count(seg):
+        gap=np.isnan(seg[0])
+        return int(gap.argmax()) if gap.any() else seg.shape[1]
+
+    def _rotate(self):
+        if self.num>=0:
+            self.seg.flush()
+        self.num+=1
+        name=os.path.join(self.path,'{:08d}.npy'.format(self.num))
+        self.seg=np.lib.format.open_memmap(name,mode='w+',dtype=float,shape=(3,self.cap))
+        self.seg[0]=np.nan
+        self.n=0
+        old=time.time()-self.days*86400
+        for x in self.segments()[:-1]:
+            seg=np.load(x,mmap_mode='r')
+            n=self._count(seg)
+            if n and seg[0,n-1]>=old:
+                break
+            del seg
+            os.remove(x)
+
+    def _saveNames(self):
+        name=os.path.join(self.path,'names.json')
+        with open(name+'.tmp','w') as f:
+            json.dump(self.names,f)
+        os.replace(name+'.tmp',name)
+
+# One round of the watch loop: {name: price} quoted at time ts
+    def append(self,ts,prices):
+        if not prices:
+            return
+        with self.lock:
+            new=[x for x in prices if x not in self.ids]
+            for x in new:
+                self.ids[x]=len(self.names)
+                self.names.append(x)
+            if new:
+                self._saveNames()
+            ins=np.array([self.ids[x] for x in prices],dtype=float)
+            vals=np.array(list(prices.values()),dtype=float)
+            i=0
+            while i<len(ins):
+                cap=self.seg.shape[1]
+                if self.n==cap:
+                    self._rotate()
+                    cap=self.cap
+                k=min(len(ins)-i,cap-self.n)
+                sl=slice(self.n,self.n+k)
+                self.seg[1,sl]=ins[i:i+k]
+                self.seg[2,sl]=vals[i:i+k]
+                self.seg[0,sl]=ts
+                self.n+=k
+                i+=k
+
+# Timestamps, instrument indices and prices of the last ticks of each
+# of names, at most rounds ticks per name, oldest first
+    def tail(self,names,rounds):
+        with self.lock:
+            want=[self.ids[x] for x in names if x in self.ids]
+            segs=self.segments()
+            cur=(self.num,self.n)
+        parts=[]
+        seen=np.zeros(len(want),dtype=int)
+        for name in reversed(segs):
+            if (seen>=rounds).all():
+                break
+            seg=np.load(name,mmap_mode='r')
+            n=cur[1] if int(os.path.basename(name).split('.')[0])==cur[0] else self._count(seg)
+            cols=seg[:,:n]
+            cols=cols[:,np.isin(cols[1],want)]
+            parts.append(cols)
+            seen+=[np.count_nonzero(cols[1]==x) for x in want]
+        if not parts:
+            return np.zeros((3,0))
+        cols=np.concatenate(parts[::-1],axis=1)
+        keep=np.zeros(cols.shape[1],dtype=bool)
+        for x in want:
+            keep[np.flatnonzero(cols[1]==x)[-rounds:]]=True
+        return cols[:,keep]
+
+# Pushes the last logged ticks of names through a TickStore, enough to
+# fill its price and derivative windows as they were before a restart
+# The names should have no ticks in the store yet
+    def replay(self,store,names,rounds=None):
+        if rounds is None:
+            rounds=store.depth+store.window
+        (ts,ins,price)=self.tail(names,rounds)
+        if len(ts)==0:
+            return 0
+        ins=ins.astype(int)
+        bounds=np.flatnonzero(np.diff(ts))+1
+        for (i,p) in zip(np.split(ins,bounds),np.split(price,bounds)):
+            store.push({self.names[x]:float(y) for (x,y) in zip(i,p)})
+        return len(bounds)+1
+
+# Every tick under path as (timestamps, names, prices), prices being a
+# matrix with a row per round and a column per name, NaN where the name
+# was not quoted that round
+def load(path='cache/ticks'):
+    with open(os.path.join(path,'names.json')) as f:
+        names=json.load(f)
+    parts=[]
+    for name in sorted(glob.glob(os.path.join(path,'*.npy'))):
+        seg=np.load(name,mmap_mode='r')
+        parts.append(seg[:,:TickLog._count(seg)])
+    cols=np.concatenate(parts,axis=1) if parts else np.zeros((3,0))
+    (ts,inv)=np.unique(cols[0],return_inverse=True)
+    prices=np.full((len(ts),len(names)),np.nan)
+    prices[inv,cols[1].astype(int)]=cols[2]
+    return (ts,names,prices)
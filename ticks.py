@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+# Second derivative from the five samples p[0], p[s], .., p[4s], newest first
+# It is the three-point backward difference (3*p[0]-4*p[1]+p[2])/2 applied
+# twice, expanded into a single linear combination
+D2 = np.array([2.25,-6.0,5.5,-2.0,0.25])
+
+# Columnar tick store for the watchlist
+# Every instrument gets a row in a preallocated ring buffer of prices,
+# and a ring buffer of second derivatives per timescale, with a running
+# count, sum and sum of squares of the non-NaN derivatives.
+# push() updates all of it for every quoted row at once.
+class TickStore:
+
+    def __init__(self,depth=5*12+1,window=15*12,strides=(1,4,12),warm=24,every=12,cap=64):
+        self.depth=depth
+        self.window=window
+        self.strides=np.array(strides)
+        self.warm=warm
+        self.every=every
+        self.rows={}
+        self.names=[]
+        k=len(strides)
+        self.price=np.full((cap,depth),np.nan)
+        self.head=np.zeros(cap,dtype=int)
+        self.count=np.zeros(cap,dtype=int)
+        self.d2=np.full((k,cap,window),np.nan)
+        self.dhead=np.zeros(cap,dtype=int)
+        self.dlen=np.zeros(cap,dtype=int)
+        self.pushes=np.zeros(cap,dtype=int)
+        self.valid=np.zeros((k,cap),dtype=int)
+        self.s=np.zeros((k,cap))
+        self.ss=np.zeros((k,cap))
+        self.std=np.full((k,cap),np.nan)
+        self.n=np.zeros((k,cap),dtype=int)
+        self.taps=self.strides[:,None]*np.arange(5)[None,:]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(list(self.names))
+
+    def __contains__(self,name):
+        return name in self.rows
+
+    def add(self,name):
+        if name in self.rows:
+            return self.rows[name]
+        if len(self.names)==len(self.head):
+            self._grow()
+        self.rows[name]=len(self.names)
+        self.names.append(name)
+        return self.rows[name]
+
+    def _grow(self):
+        cap=len(self.head)
+        def more(a,axis,fill):
+            shape=list(a.shape)
+            shape[axis]=cap
+            return np.concatenate([a,np.full(shape,fill,dtype=a.dtype)],axis=axis)
+        self.price=more(self.price,0,np.nan)
+        for x in ['head','count','dhead','dlen','pushes']:
+            setattr(self,x,more(getattr(self,x),0,0))
+        self.d2=more(self.d2,1,np.nan)
+        for x in ['valid','s','ss','n']:
+            setattr(self,x,more(getattr(self,x),1,0))
+        self.std=more(self.std,1,np.nan)
+
+# Prices of one row, newest first
+    def history(self,name):
+        r=self.rows[name]
+        c=self.count[r]
+        return self.price[r,(self.head[r]-np.arange(c))%self.depth]
+
+# Newest price, derivatives (NaN if not yet defined) and standard deviations
+    def latest(self,name):
+        r=self.rows[name]
+        if self.count[r]==0:
+            return (None,None,None)
+        return (self.price[r,self.head[r]],self.d2[:,r,self.dhead[r]],self.std[:,r])
+
+# Trigger level for each timescale and row
+# Rows still warming up get 1000, which nothing realistic crosses
+    def threshold(self,nsd):
+        return np.where(np.isnan(self.std),1000.0,nsd*self.std)
+
+# Appends one tick for every row in prices (name -> price)
+# Returns the rows that were updated and their derivatives
+    def push(self,prices):
+        rows=np.array([self.add(x) for x in prices],dtype=int)
+        if len(rows)==0:
+            return (rows,np.zeros((len(self.strides),0)))
+        vals=np.array(list(prices.values()),dtype=float)
+
+        self.head[rows]=(self.head[rows]+1)%self.depth
+        self.price[rows,self.head[rows]]=vals
+        self.count[rows]=np.minimum(self.count[rows]+1,self.depth)
+
+        idx=(self.head[rows][None,:,None]-self.taps[:,None,:])%self.depth
+        d2=self.price[rows[None,:,None],idx]@D2
+        d2[self.count[rows][None,:]<=4*self.strides[:,None]]=np.nan
+
+        self.dhead[rows]=(self.dhead[rows]+1)%self.window
+        dh=self.dhead[rows]
+        old=self.d2[:,rows,dh]
+        gone=~np.isnan(old)
+        old=np.where(gone,old,0.0)
+        self.valid[:,rows]-=gone
+        self.s[:,rows]-=old
+        self.ss[:,rows]-=old*old
+        self.d2[:,rows,dh]=d2
+        new=~np.isnan(d2)
+        d=np.where(new,d2,0.0)
+        self.valid[:,rows]+=new
+        self.s[:,rows]+=d
+        self.ss[:,rows]+=d*d
+        self.dlen[rows]=np.minimum(self.dlen[rows]+1,self.window)
+
+# Rebuild the sums from the buffer once per window to stop float drift
+        self.pushes[rows]+=1
+        r=rows[self.pushes[rows]%self.window==0]
+        if len(r):
+            buf=self.d2[:,r,:]
+            self.s[:,r]=np.nansum(buf,axis=2)
+            self.ss[:,r]=np.nansum(buf*buf,axis=2)
+
+        self._updateStd(rows)
+        return (rows,d2)
+
+# Below warm valid samples there is no deviation yet.
+# While the window still holds gaps the deviation is recomputed every
+# tick; once it is full of samples, only every (every+1)th tick.
+    def _updateStd(self,rows):
+        valid=self.valid[:,rows]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            var=(self.ss[:,rows]-self.s[:,rows]**2/valid)/(valid-1)
+        std=np.sqrt(np.maximum(var,0.0))
+        warm=valid<self.warm
+        gaps=~warm & (valid<self.dlen[rows][None,:])
+        full=~warm & ~gaps
+        n=self.n[:,rows]
+        redo=full & (n>=self.every)
+        held=self.std[:,rows]
+        held=np.where(warm,np.nan,held)
+        held=np.where(gaps|redo,std,held)
+        self.std[:,rows]=held
+        self.n[:,rows]=np.where(full,np.where(redo,0,n+1),n)
+
+# What push() and threshold() would give, over a fresh store, for a
+# whole history at once. prices has a row per round and a column per
+# instrument, NaN where it was not quoted. Returns |d2| / std per round,
+# stride and column, with inf where a row still warming up crosses 1000
+# and 0 where there is no derivative or no quote. A round flags a column
+# at nsd when any of its strides is above nsd.
+# The held deviation is refreshed on the same schedule as in push():
+# every tick while the window has gaps, then every (every+1)th tick.
+    def ratios(self,prices):
+        res=np.zeros((prices.shape[0],len(self.strides),prices.shape[1]),dtype=np.float32)
+        for c in range(prices.shape[1]):
+            at=np.flatnonzero(~np.isnan(prices[:,c]))
+            x=prices[at,c]
+            n=len(x)
+            j=np.arange(n)
+            lo=np.maximum(j+1-self.window,0)
+            def win(a):
+                cs=np.concatenate([[0.0],np.cumsum(a)])
+                return cs[j+1]-cs[lo]
+            for b,st in enumerate(self.strides):
+                d2=np.full(n,np.nan)
+                if n>4*st:
+                    d2[4*st:]=sum(D2[i]*x[(4-i)*st:n-i*st] for i in range(5))
+                ok=~np.isnan(d2)
+                d=np.where(ok,d2,0.0)
+                valid=win(ok)
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    var=(win(d*d)-win(d)**2/valid)/(valid-1)
+                std=np.sqrt(np.maximum(var,0.0))
+                warm=valid<self.warm
+                gaps=~warm & (valid<np.minimum(j+1,self.window))
+                full=~warm & ~gaps
+                redo=full & ((np.cumsum(full)-1)%(self.every+1)==self.every)
+                last=np.maximum.accumulate(np.where(warm|gaps|redo,j,-1))
+                held=np.where((last<0)|warm[np.maximum(last,0)],np.nan,std[np.maximum(last,0)])
+                a=np.abs(d2)
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    r=np.where(np.isnan(held),np.where(a>1000.0,np.inf,0.0),a/held)
+                res[at,b,c]=np.nan_to_num(r,nan=0.0,posinf=np.inf)
+        return res
+
+# Names of the rows in rows whose derivative crossed its threshold
+    def flags(self,rows,d2,nsd):
+        with np.errstate(invalid='ignore'):
+            hit=(np.abs(d2)>self.threshold(nsd)[:,rows]).any(axis=0)
+        return [self.names[x] for x in rows[hit]]
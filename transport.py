@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import random
+import datetime
+from threading import Lock
+from collections import defaultdict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Transports that can be mounted under RHAPI.session (see RHAPI.mount)
+# A fixture is a json-lines file with one recorded response per line
+
+# Query parameters that change from run to run and are left out of keys
+VOLATILE = ['updated_at[gte]']
+
+# Query parameters in a fixed order, so the same request always
+# matches the same recording
+def _key(method,url):
+    u=urlsplit(url)
+    q=urlencode(sorted(x for x in parse_qsl(u.query,keep_blank_values=True) if x[0] not in VOLATILE))
+    return '{} {}://{}{}?{}'.format(method,u.scheme,u.netloc,u.path,q)
+
+# Tokens are never written to a fixture
+def _scrub(text):
+    try:
+        data=json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(data,dict):
+        for k in ['access_token','refresh_token']:
+            if k in data:
+                data[k]='recorded'
+    return json.dumps(data)
+
+def _response(request,status,headers,body,start):
+    res=Response()
+    res.elapsed=datetime.timedelta(seconds=time.time()-start)
+    res.status_code=status
+    res.headers=CaseInsensitiveDict(headers)
+    res._content=body.encode()
+    res.encoding='utf-8'
+    res.url=request.url
+    res.request=request
+    res.reason='Replayed'
+    return res
+
+# Sends requests for real and appends every response to the fixture
+class RecordAdapter(HTTPAdapter):
+
+    def __init__(self,path,**kwargs):
+        HTTPAdapter.__init__(self,**kwargs)
+        self.path=path
+        self.lock=Lock()
+
+    def send(self,request,**kwargs):
+        res=HTTPAdapter.send(self,request,**kwargs)
+        entry={
+            'key':_key(request.method,request.url),
+            'status':res.status_code,
+            'headers':{k:v for k,v in res.headers.items() if k.lower() in ['content-type','retry-after']},
+            'body':_scrub(res.text)
+        }
+        with self.lock:
+            with open(self.path,'a') as f:
+                f.write(json.dumps(entry)+'\n')
+        return res
+
+# Serves a fixture instead of the network
+# Repeated requests get the recorded responses in order, then the last
+# one again. latency seconds are added to every request, and a share of
+# requests (p401, p429) fail with a 401 or a 429 carrying Retry-After.
+# Token requests that were never recorded get a made-up token, so
+# logins and refreshes work offline. Anything else unknown is a 404.
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self,path,latency=0.0,p401=0.0,p429=0.0,retry=1,seed=0):
+        BaseAdapter.__init__(self)
+        self.latency=latency
+        self.p401=p401
+        self.p429=p429
+        self.retry=retry
+        self.rand=random.Random(seed)
+        self.lock=Lock()
+        self.fixture=defaultdict(list)
+        with open(path) as f:
+            for l in f:
+                if l.strip():
+                    x=json.loads(l)
+                    self.fixture[x['key']].append(x)
+        self.seen=defaultdict(int)
+        self.count=0
+
+    def send(self,request,**kwargs):
+        start=time.time()
+        if self.latency:
+            time.sleep(self.latency)
+        key=_key(request.method,request.url)
+        with self.lock:
+            self.count+=1
+            r=self.rand.random()
+            n=self.seen[key]
+            self.seen[key]+=1
+        login='/oauth2/token/' in request.url
+        if not login and r<self.p401:
+            return _response(request,401,{'Content-Type':'application/json'},'{"detail":"Injected 401"}',start)
+        if not login and r<self.p401+self.p429:
+            return _response(request,429,{'Content-Type':'application/json','Retry-After':str(self.retry)},'{"detail":"Injected 429"}',start)
+        rec=self.fixture.get(key)
+        if rec:
+            x=rec[min(n,len(rec)-1)]
+            return _response(request,x['status'],x['headers'],x['body'],start)
+        if login:
+            return _response(request,200,{'Content-Type':'application/json'},
+                json.dumps({'access_token':'replay','refresh_token':'replay','expires_in':86400}),start)
+        return _response(request,404,{'Content-Type':'application/json'},'{"detail":"Not recorded"}',start)
+
+    def close(self):
+        pass